@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+class _KeyState:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiters = deque()
+        self.paused_until = 0.0
+        self.wake_handle = None
+        self.successes = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.throttled = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class AdmissionController:
+    """Admission control for outbound LLM calls, per (llm_type, api_key).
+
+    At most `limit` calls per key run at once (max_in_flight, or a per-provider
+    value from limits); further callers wait in a FIFO queue of at most
+    max_queue, each for up to queue_timeout seconds. A full queue is rejected
+    straight away with 429, a wait that runs out with 503, both carrying
+    Retry-After. When the provider answers 429, the key pauses for its
+    Retry-After (default_backoff without one) and its limit halves; each
+    `limit` successes in a row then raise it by one again, up to the maximum.
+    """
+
+    def __init__(self, max_in_flight=8, max_queue=64, queue_timeout=10.0, default_backoff=1.0, limits=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.default_backoff = default_backoff
+        self.limits = limits or {}
+        self.keys = {}
+
+    def _state(self, key):
+        state = self.keys.get(key)
+        if state is None:
+            state = self.keys[key] = _KeyState(self._max_limit(key))
+        return state
+
+    def _max_limit(self, key):
+        return self.limits.get(key[0], self.max_in_flight)
+
+    def _wake(self, key, state):
+        state.wake_handle = None
+        now = time.monotonic()
+        if state.paused_until > now:
+            if state.waiters:
+                state.wake_handle = asyncio.get_running_loop().call_later(state.paused_until - now, self._wake, key, state)
+            return
+        while state.waiters and state.in_flight < state.limit:
+            waiter = state.waiters.popleft()
+            if not waiter.done():
+                state.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self, key):
+        state = self._state(key)
+        if not state.waiters and state.in_flight < state.limit and state.paused_until <= time.monotonic():
+            state.in_flight += 1
+            state.admitted += 1
+            return
+        if len(state.waiters) >= self.max_queue:
+            state.rejected += 1
+            raise HTTPException(status_code=429, detail=f"Too many queued requests for this {key[0]} key",
+                                headers={"Retry-After": str(max(int(self.queue_timeout), 1))})
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        if state.wake_handle is None:
+            self._wake(key, state)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted just as we gave up: hand the slot on
+                self.release(key)
+            else:
+                waiter.cancel()
+                if waiter in state.waiters:
+                    state.waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            state.timed_out += 1
+            raise HTTPException(status_code=503, detail=f"Timed out waiting for {key[0]} capacity",
+                                headers={"Retry-After": str(max(int(self.queue_timeout), 1))})
+        waited = time.monotonic() - start
+        state.admitted += 1
+        state.waited += 1
+        state.wait_total += waited
+        state.wait_max = max(state.wait_max, waited)
+
+    def release(self, key):
+        state = self._state(key)
+        state.in_flight -= 1
+        self._wake(key, state)
+
+    def record_success(self, key):
+        state = self._state(key)
+        state.successes += 1
+        if state.limit < self._max_limit(key) and state.successes >= state.limit:
+            state.limit += 1
+            state.successes = 0
+            self._wake(key, state)
+
+    def throttle(self, key, retry_after=None):
+        """The provider answered 429: pause the key and halve its concurrency."""
+        state = self._state(key)
+        delay = float(retry_after) if retry_after and str(retry_after).isdigit() else self.default_backoff
+        state.paused_until = max(state.paused_until, time.monotonic() + delay)
+        state.limit = max(state.limit // 2, 1)
+        state.successes = 0
+        state.throttled += 1
+        logger.info(f"{key[0]} rate limited; pausing {delay:.1f}s, limit now {state.limit}")
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            f"{llm_type}:{api_key[-4:]}": {
+                "in_flight": state.in_flight,
+                "limit": state.limit,
+                "queued": len(state.waiters),
+                "paused_for": round(max(state.paused_until - now, 0), 3),
+                "admitted": state.admitted,
+                "rejected": state.rejected,
+                "timed_out": state.timed_out,
+                "throttled": state.throttled,
+                "queue_wait_avg": round(state.wait_total / state.waited, 4) if state.waited else 0,
+                "queue_wait_max": round(state.wait_max, 4)
+            }
+            for (llm_type, api_key), state in self.keys.items()
+        }
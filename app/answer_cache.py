@@ -0,0 +1,88 @@
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """Per-agent cache of LLM answers matched by query embedding similarity.
+
+    An answer is reused when a new question's embedding has cosine similarity
+    of at least threshold with a cached one for the same agent, and the
+    language, first-turn flag and retrieved-context hash all match exactly -
+    so a change in the RAG data or conversation stage never serves a stale
+    answer. Entries expire after ttl seconds; max_entries bounds the cache
+    across all agents with least-recently-used eviction.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries=5000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # entry id -> entry, in LRU order
+        self._by_agent = {}  # agent_id -> set of entry ids
+        self._next_id = 0
+
+    @staticmethod
+    def _normalize(embedding):
+        if isinstance(embedding, str):  # pgvector values read back from Supabase
+            embedding = json.loads(embedding)
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            ids = self._by_agent.get(entry["agent_id"])
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._by_agent[entry["agent_id"]]
+
+    def lookup(self, agent_id, embedding, language, context_hash, first_turn):
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        best_id, best_score = None, self.threshold
+        for entry_id in list(self._by_agent.get(agent_id, ())):
+            entry = self._entries[entry_id]
+            if entry["expires_at"] < now:
+                self._remove(entry_id)
+                continue
+            if (entry["language"], entry["context_hash"], entry["first_turn"]) != (language, context_hash, first_turn):
+                continue
+            score = float(np.dot(entry["embedding"], query))
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        if best_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(best_id)
+        return self._entries[best_id]["answer"]
+
+    def store(self, agent_id, embedding, language, context_hash, first_turn, answer):
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = {
+            "agent_id": agent_id,
+            "embedding": self._normalize(embedding),
+            "language": language,
+            "context_hash": context_hash,
+            "first_turn": first_turn,
+            "answer": answer,
+            "expires_at": time.monotonic() + self.ttl
+        }
+        self._by_agent.setdefault(agent_id, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, agent_id):
+        for entry_id in list(self._by_agent.get(agent_id, ())):
+            self._remove(entry_id)
+
+    def stats(self):
+        return {"entries": len(self._entries), "agents": len(self._by_agent), "hits": self.hits, "misses": self.misses}
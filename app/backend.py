@@ -2,6 +2,7 @@ import os
 import asyncio
 import aiohttp
 from fastapi import FastAPI, HTTPException, Form, UploadFile, File
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -12,12 +13,28 @@ from datetime import datetime
 import logging
 import json
 from typing import List, Optional
-import PyPDF2
-import io
 from functools import lru_cache
 import time
 import re  # Added for sanitization
 import hashlib  # Added for hashing
+import numpy as np
+from concurrent.futures.process import BrokenProcessPool
+from .answer_cache import SemanticAnswerCache
+from .caches import LRUCache, RefreshingTokenCache
+from .context import assemble_context
+from .db import BatchWriter, SupabaseExecutor
+from .embedding import EmbeddingBatcher
+from .extraction import DocumentExtractor, spool_upload
+from .history import HistoryManager
+from .prompts import PromptCacheStats, agent_prefix, prompt_usage, session_details
+from .sessions import MemorySessionStore, SupabaseSessionStore
+from .http_client import HttpClientManager
+from .tickets import TicketQueue
+from .lexical_index import LexicalIndex
+from .admission import AdmissionController
+from .llm_router import LLMRouter
+from .vector_index import LocalVectorIndex
+from .ingest import chunk_hash, content_hash, hashed_chunks, expand_archive, extract_text, is_archive, is_supported
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -30,75 +47,628 @@ if not all([supabase_url, supabase_key, deepseek_api_key]):
     logger.error("Missing environment variables")
     raise ValueError("Missing SUPABASE_URL, SUPABASE_KEY, or DEEPSEEK_API_KEY")
 supabase_client = supabase.create_client(supabase_url, supabase_key)
+embedding_model_name = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+rag_chunk_size = int(os.getenv("RAG_CHUNK_SIZE", "1000"))
+rag_chunk_overlap = int(os.getenv("RAG_CHUNK_OVERLAP", "200"))
+rag_content_cache_mb = int(os.getenv("RAG_CONTENT_CACHE_MB", "64"))
+rag_fetch_concurrency = int(os.getenv("RAG_FETCH_CONCURRENCY", "8"))
+rag_fetch_timeout = float(os.getenv("RAG_FETCH_TIMEOUT", "5"))
+embedding_cache_size = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+embedding_cache_ttl = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+embed_max_batch_size = int(os.getenv("EMBED_MAX_BATCH_SIZE", "32"))
+embed_batch_window_ms = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+# Pooled keep-alive session for all outbound HTTP (LLM providers, Zoho, Zendesk)
+http_client = HttpClientManager(
+    limit=int(os.getenv("HTTP_POOL_LIMIT", "100")),
+    limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20")),
+    dns_cache_ttl=int(os.getenv("HTTP_DNS_CACHE_TTL", "300")),
+    connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+    read_timeout=float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+)
+zoho_token_refresh_margin = int(os.getenv("ZOHO_TOKEN_REFRESH_MARGIN", "300"))
+zoho_contact_cache_size = int(os.getenv("ZOHO_CONTACT_CACHE_SIZE", "10000"))
+zoho_contact_cache_ttl = float(os.getenv("ZOHO_CONTACT_CACHE_TTL", "86400"))
+ticket_workers = int(os.getenv("TICKET_WORKERS", "4"))
+ticket_platform_concurrency = int(os.getenv("TICKET_PLATFORM_CONCURRENCY", "2"))
+ticket_max_attempts = int(os.getenv("TICKET_MAX_ATTEMPTS", "6"))
+# A "running" ticket job claimed longer ago than this is assumed orphaned by a dead process
+ticket_lease_timeout = float(os.getenv("TICKET_LEASE_TIMEOUT", "300"))
+agent_cache_size = int(os.getenv("AGENT_CACHE_SIZE", "1000"))
+agent_cache_ttl = float(os.getenv("AGENT_CACHE_TTL", "60"))
+answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", "5000"))
+# Cached answers are only served this early in a conversation; later turns depend on history
+answer_cache_max_history = int(os.getenv("ANSWER_CACHE_MAX_HISTORY", "1"))
+# Prompt budget in tokens (system prompt + history + message); PROMPT_TOKEN_BUDGET_<LLM> overrides per model
+prompt_token_budget = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+prompt_token_budgets = {
+    llm: int(os.getenv(f"PROMPT_TOKEN_BUDGET_{llm.upper()}", prompt_token_budget))
+    for llm in ("deepseek", "gpt", "grok", "gemini")
+}
+history_summary_tokens = int(os.getenv("HISTORY_SUMMARY_TOKENS", "300"))
+history_summary_cache_size = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "10000"))
+history_summary_cache_ttl = float(os.getenv("HISTORY_SUMMARY_CACHE_TTL", "3600"))
+# LLM deadlines in seconds (LLM_TOTAL_TIMEOUT_GEMINI etc. override per provider), circuit breakers and hedging
+llm_default_deadlines = {
+    "connect": float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+    "first_byte": float(os.getenv("LLM_FIRST_BYTE_TIMEOUT", "15")),
+    "total": float(os.getenv("LLM_TOTAL_TIMEOUT", "60"))
+}
+llm_deadlines = {
+    llm: {name: float(os.getenv(f"LLM_{name.upper()}_TIMEOUT_{llm.upper()}", value)) for name, value in llm_default_deadlines.items()}
+    for llm in ("deepseek", "gpt", "grok", "gemini")
+}
+llm_breaker_settings = {
+    "error_rate": float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5")),
+    "latency_threshold": float(os.getenv("LLM_BREAKER_LATENCY", "30")),
+    "cooldown": float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+}
+# Admission control per (llm_type, api_key): LLM_MAX_IN_FLIGHT_<LLM> overrides the in-flight cap per provider
+llm_max_in_flight = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+llm_max_in_flight_by_provider = {
+    llm: int(os.getenv(f"LLM_MAX_IN_FLIGHT_{llm.upper()}", llm_max_in_flight))
+    for llm in ("deepseek", "gpt", "grok", "gemini")
+}
+llm_max_queue = int(os.getenv("LLM_MAX_QUEUE", "64"))
+llm_queue_timeout = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+llm_hedging = os.getenv("LLM_HEDGING", "false").lower() == "true"
+llm_hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+llm_hedge_min_delay = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+# Retrieved context: CONTEXT_CANDIDATES hits per query, cut by similarity and a token budget
+# (CONTEXT_TOKEN_BUDGET_<LLM> overrides per model; agents can override both)
+context_candidates = int(os.getenv("CONTEXT_CANDIDATES", "8"))
+context_min_similarity = float(os.getenv("CONTEXT_MIN_SIMILARITY", "0.25"))
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+context_token_budgets = {
+    llm: int(os.getenv(f"CONTEXT_TOKEN_BUDGET_{llm.upper()}", context_token_budget))
+    for llm in ("deepseek", "gpt", "grok", "gemini")
+}
+# "memory" keeps conversations in this process; "supabase" shares them across workers and restarts
+session_store = os.getenv("SESSION_STORE", "memory")
+session_max_conversations = int(os.getenv("SESSION_MAX_CONVERSATIONS", "10000"))
+session_ttl = float(os.getenv("SESSION_TTL", "86400"))
+# Bulk uploads: documents per request and total unpacked size
+rag_bulk_max_files = int(os.getenv("RAG_BULK_MAX_FILES", "200"))
+rag_bulk_max_mb = int(os.getenv("RAG_BULK_MAX_MB", "100"))
+# Extraction worker processes, and each document's wall-clock and CPU allowance
+rag_extract_workers = int(os.getenv("RAG_EXTRACT_WORKERS", "4"))
+rag_extract_timeout = float(os.getenv("RAG_EXTRACT_TIMEOUT", "60"))
+rag_extract_cpu_seconds = int(os.getenv("RAG_EXTRACT_CPU_SECONDS", "30"))
+# Uploads larger than this are spooled to a temp file instead of kept in memory
+rag_upload_spool_bytes = int(os.getenv("RAG_UPLOAD_SPOOL_MB", "2")) * 1024 * 1024
+# Storage uploads of up to 10MB need far longer than SUPABASE_TIMEOUT's row queries
+rag_storage_timeout = float(os.getenv("RAG_STORAGE_TIMEOUT", "120"))
+# "rpc" queries match_rag_chunks in Postgres; "local" serves retrieval from an in-process index
+retrieval_backend = os.getenv("RETRIEVAL_BACKEND", "rpc")
+local_index_ann_threshold = int(os.getenv("LOCAL_INDEX_ANN_THRESHOLD", "20000"))
+# Opt-in, per-process BM25 index fused with vector results; with LEXICAL_SHORTCUT, confident lexical hits skip the embedding step
+lexical_index_enabled = os.getenv("LEXICAL_INDEX", "false").lower() == "true"
+# Lexical hits the vector search didn't find are only fused in at or above this confidence
+lexical_min_confidence = float(os.getenv("LEXICAL_MIN_CONFIDENCE", "0.5"))
+lexical_shortcut = os.getenv("LEXICAL_SHORTCUT", "false").lower() == "true"
+lexical_shortcut_confidence = float(os.getenv("LEXICAL_SHORTCUT_CONFIDENCE", "1.0"))
+# Blocking supabase-py calls run on their own pool so they never stall the event loop
+db = SupabaseExecutor(
+    max_workers=int(os.getenv("SUPABASE_MAX_CONCURRENCY", "16")),
+    timeout=float(os.getenv("SUPABASE_TIMEOUT", "10"))
+)
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 class SupabaseVectorStore:
-    def __init__(self, client):
+    def __init__(self, client, db, batcher, chunk_size=1000, chunk_overlap=200, embed_batch_size=64, insert_batch_size=500,
+                 content_cache_bytes=64 * 1024 * 1024, fetch_concurrency=8, fetch_timeout=5.0,
+                 embedding_cache_size=10000, embedding_cache_ttl=3600, local_index=None,
+                 lexical_index=None, lexical_shortcut_confidence=None, lexical_min_confidence=0.5, rrf_k=60):
         self.client = client
-        self.embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        self.db = db
+        self.batcher = batcher
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.embed_batch_size = embed_batch_size
+        self.insert_batch_size = insert_batch_size
+        # Extracted document text keyed by file_path, bounded by total characters
+        self.content_cache = LRUCache(content_cache_bytes, sizeof=len)
+        self.fetch_concurrency = fetch_concurrency
+        self.fetch_timeout = fetch_timeout
+        # L1 for query_embeddings keyed by content_hash; new embeddings are persisted by the writer
+        self.embedding_cache = LRUCache(embedding_cache_size, ttl=embedding_cache_ttl)
+        self.embedding_writer = BatchWriter(db, client, "query_embeddings")
+        self.embedding_db_hits = 0
+        self.embedding_computed = 0
+        # In-process LocalVectorIndex replacing the match_rag_chunks RPC; None means use the RPC
+        self.local_index = local_index
+        # In-process BM25 LexicalIndex fused with vector hits by reciprocal rank; None disables it.
+        # When the top lexical hit's confidence reaches lexical_shortcut_confidence, search skips embedding.
+        # Lexical-only hits carry no similarity for the match threshold, so they need lexical_min_confidence.
+        self.lexical_index = lexical_index
+        self.lexical_shortcut_confidence = lexical_shortcut_confidence
+        self.lexical_min_confidence = lexical_min_confidence
+        self.rrf_k = rrf_k
+        self.lexical_shortcuts = 0
+        # (user_id, agent_id) -> whether any of its files predate chunking; new uploads never add such files
+        self.legacy_files = LRUCache(10000, ttl=300)
+        self.chunks_embedded = 0
+        self.chunks_reused = 0
 
     async def _get_embedding(self, text):
         content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
-        response = self.client.table("query_embeddings").select("embedding").eq("content_hash", content_hash).execute()
+        embedding = self.embedding_cache.get(content_hash)
+        if embedding is not None:
+            return embedding
+        response = await self.db.execute(self.client.table("query_embeddings").select("embedding").eq("content_hash", content_hash))
         if response.data:
-            return response.data[0]["embedding"]
-        loop = asyncio.get_event_loop()
-        embedding = await loop.run_in_executor(None, lambda: self.embedder.encode(text).tolist())
-        self.client.table("query_embeddings").insert({
-            "query": content_hash,
-            "content_hash": content_hash,
-            "embedding": embedding,
-            "timestamp": datetime.now().isoformat()
-        }).execute()
+            embedding = response.data[0]["embedding"]
+            self.embedding_db_hits += 1
+        else:
+            embedding = await self.batcher.encode(text)
+            self.embedding_computed += 1
+            self.embedding_writer.add(content_hash, {
+                "query": content_hash,
+                "content_hash": content_hash,
+                "embedding": embedding,
+                "timestamp": datetime.now().isoformat()
+            })
+        self.embedding_cache.set(content_hash, embedding)
         return embedding
 
+    def stats(self):
+        return {
+            "embedding_cache": self.embedding_cache.stats(),
+            "embedding_db_hits": self.embedding_db_hits,
+            "embedding_computed": self.embedding_computed,
+            "embedding_writer": self.embedding_writer.stats(),
+            "embedding_batcher": self.batcher.stats(),
+            "content_cache": self.content_cache.stats(),
+            "local_index": self.local_index.stats() if self.local_index is not None else None,
+            "lexical_index": self.lexical_index.stats() if self.lexical_index is not None else None,
+            "lexical_shortcuts": self.lexical_shortcuts,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_reused": self.chunks_reused
+        }
+
+    def _download_and_extract(self, file_path):
+        response = self.client.storage.from_("ragfiles").download(file_path)
+        return extract_text(file_path, response)
+
+    def _load_file_content(self, file_path):
+        response = self.client.table("rag_metadata").select("content").eq("file_path", file_path).limit(1).execute()
+        content = response.data[0].get("content") if response.data else None
+        if content is None:
+            # Uploaded before extracted text was persisted: parse the original once and backfill
+            content = self._download_and_extract(file_path)
+            self.client.table("rag_metadata").update({"content": content}).eq("file_path", file_path).execute()
+        return content
+
     async def _get_file_content(self, file_path):
+        content = self.content_cache.get(file_path)
+        if content is not None:
+            return content
         try:
-            response = self.client.storage.from_("ragfiles").download(file_path)
-            if file_path.endswith(".pdf"):
-                pdf_reader = PyPDF2.PdfReader(io.BytesIO(response))
-                return "".join(page.extract_text() for page in pdf_reader.pages if page.extract_text())
-            return response.decode("utf-8")
+            content = await self.db.run(self._load_file_content, file_path)
+            self.content_cache.set(file_path, content)
+            return content
         except Exception as e:
             logger.error(f"Failed to fetch file content from {file_path}: {e}")
             return ""
 
-    async def search(self, query, user_id, agent_id=None, limit=3):
+    async def _resolve_hit(self, r, semaphore):
+        async with semaphore:
+            try:
+                content = await asyncio.wait_for(self._get_file_content(r["file_path"]), self.fetch_timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Timed out fetching content for {r['file_path']} after {self.fetch_timeout}s")
+                return None
+        if not content:
+            return None
+        return {"content": content, "metadata": r["metadata"]}
+
+    async def _resolve_hits(self, rows):
+        """Fetch content for all hits concurrently; slow or failed hits are dropped, ranking is kept."""
+        semaphore = asyncio.Semaphore(self.fetch_concurrency)
+        resolved = await asyncio.gather(*(self._resolve_hit(r, semaphore) for r in rows))
+        return [r for r in resolved if r is not None]
+
+    def forget_file(self, file_path, user_id, agent_id):
+        self.content_cache.pop(file_path)
+        if self.local_index is not None:
+            self.local_index.remove_file(user_id, agent_id, file_path)
+        if self.lexical_index is not None:
+            self.lexical_index.remove_file(user_id, agent_id, file_path)
+
+    async def load_indexes(self, page_size=1000):
+        """Fill the in-process vector and/or lexical indexes from rag_chunks (run once at startup)."""
+        metadata_by_id = {}
+        offset = 0
+        while True:
+            response = await self.db.execute(
+                self.client.table("rag_metadata").select("id, metadata").range(offset, offset + page_size - 1)
+            )
+            metadata_by_id.update({r["id"]: r["metadata"] for r in response.data})
+            if len(response.data) < page_size:
+                break
+            offset += page_size
+        # The lexical index alone doesn't need the embeddings, which are most of each row
+        columns = "*" if self.local_index is not None else "id, rag_id, user_id, agent_id, file_path, chunk_index, start_offset, end_offset, content"
+        offset = 0
+        total = 0
+        while True:
+            response = await self.db.execute(
+                self.client.table("rag_chunks").select(columns).order("id").range(offset, offset + page_size - 1)
+            )
+            partitions = {}
+            for r in response.data:
+                r["metadata"] = metadata_by_id.get(r["rag_id"], {})
+                partitions.setdefault((r["user_id"], r["agent_id"]), []).append(r)
+            for (user_id, agent_id), rows in partitions.items():
+                if self.lexical_index is not None:
+                    await self.lexical_index.add(user_id, agent_id, rows)
+                if self.local_index is not None:
+                    await self.local_index.add(user_id, agent_id, rows)
+            total += len(response.data)
+            if len(response.data) < page_size:
+                break
+            offset += page_size
+        logger.info(f"Loaded {total} chunks into the in-process indexes")
+
+    async def _match_chunks(self, query_embedding, user_id, agent_id, limit):
+        if self.local_index is not None:
+            return self.local_index.search(query_embedding, user_id, agent_id, limit)
+        response = await self.db.execute(self.client.rpc(
+            "match_rag_chunks",
+            {"query_embedding": query_embedding, "user_id": user_id, "agent_id": agent_id, "match_limit": limit}
+        ))
+        return response.data
+
+    async def _embed_batch(self, texts):
+        return await self.batcher.encode_many(texts, self.embed_batch_size)
+
+    async def _search_legacy(self, query_embedding, user_id, agent_id, limit):
+        # Files uploaded before chunking have a single whole-document embedding and no chunk rows
+        response = await self.db.execute(self.client.rpc(
+            "match_rag_files",
+            {"query_embedding": query_embedding, "user_id": user_id, "agent_id": agent_id, "match_limit": limit}
+        ))
+        return await self._resolve_hits([{**r, "metadata": {**r["metadata"], "similarity": r.get("similarity")}}
+                                         for r in response.data or [] if r["metadata"].get("chunk_count") is None])
+
+    async def _has_legacy_files(self, user_id, agent_id):
+        key = (user_id, agent_id)
+        found = self.legacy_files.get(key)
+        if found is None:
+            query = self.client.table("rag_metadata").select("id").eq("user_id", user_id).is_("metadata->>chunk_count", "null")
+            if agent_id is not None:
+                query = query.eq("agent_id", agent_id)
+            try:
+                found = bool((await self.db.execute(query.limit(1))).data)
+            except Exception as e:
+                logger.error(f"Checking for pre-chunking RAG files failed: {e}")
+                return False
+            self.legacy_files.set(key, found)
+        return found
+
+    @staticmethod
+    def _merge_legacy(results, legacy, limit):
+        """Merge whole-file legacy hits (by similarity) into the ranked chunk results, keeping both orders."""
+        merged = []
+        results, legacy = list(results), list(legacy)
+        while (results or legacy) and len(merged) < limit:
+            chunk_similarity = results[0]["metadata"].get("similarity") if results else None
+            legacy_similarity = legacy[0]["metadata"].get("similarity") if legacy else None
+            if legacy and (not results or (chunk_similarity is not None and legacy_similarity is not None
+                                           and legacy_similarity > chunk_similarity)):
+                merged.append(legacy.pop(0))
+            else:
+                merged.append(results.pop(0))
+        return merged
+
+    @staticmethod
+    def _chunk_result(r):
+        metadata = dict(r.get("metadata") or {})
+        metadata.update({
+            "file_path": r["file_path"],
+            "chunk_index": r["chunk_index"],
+            "start_offset": r["start_offset"],
+            "end_offset": r["end_offset"],
+            "similarity": r.get("similarity")
+        })
+        if "bm25" in r:
+            metadata["bm25"] = r["bm25"]
+        return {"content": r["content"], "metadata": metadata}
+
+    def _fuse(self, vector_hits, lexical_hits, limit):
+        """Reciprocal-rank fusion of vector and lexical hits on (file_path, chunk_index).
+
+        A lexical hit the vector search didn't return is only added when its
+        confidence reaches lexical_min_confidence; weaker ones can still lift a vector hit.
+        """
+        fused = {}
+        for hits in (vector_hits, lexical_hits):
+            for rank, hit in enumerate(hits):
+                key = (hit["file_path"], hit["chunk_index"])
+                if key not in fused and hit.get("confidence", 1.0) < self.lexical_min_confidence:
+                    continue
+                entry = fused.setdefault(key, {"hit": {}, "score": 0.0})
+                entry["hit"].update(hit)
+                entry["score"] += 1.0 / (self.rrf_k + rank + 1)
+        ranked = sorted(fused.values(), key=lambda e: e["score"], reverse=True)[:limit]
+        return [e["hit"] for e in ranked]
+
+    async def search(self, query, user_id, agent_id=None, limit=3, return_embedding=False):
+        """Return the best-matching chunks; with return_embedding, (results, query_embedding).
+
+        query_embedding is None when a confident lexical match let the search skip embedding.
+        """
         logger.info(f"Starting search for query: '{query}', user_id: {user_id}, agent_id: {agent_id}")
+        query_embedding = None
         try:
+            lexical_hits = self.lexical_index.search(query, user_id, agent_id, limit) if self.lexical_index is not None else []
+            if (lexical_hits and self.lexical_shortcut_confidence is not None
+                    and lexical_hits[0]["confidence"] >= self.lexical_shortcut_confidence):
+                self.lexical_shortcuts += 1
+                results = [self._chunk_result(r) for r in lexical_hits]
+                return (results, query_embedding) if return_embedding else results
             query_embedding = await self._get_embedding(query)
-            response = self.client.rpc(
-                "match_rag_files",
-                {"query_embedding": query_embedding, "user_id": user_id, "agent_id": agent_id, "match_limit": limit}
-            ).execute()
-            if not response.data:
+            matches = await self._match_chunks(query_embedding, user_id, agent_id, limit)
+            if lexical_hits:
+                matches = self._fuse(matches, lexical_hits, limit)
+            results = [self._chunk_result(r) for r in matches]
+            # match_rag_chunks has no threshold, so files from before chunking are searched whenever the agent has any
+            if not matches or await self._has_legacy_files(user_id, agent_id):
+                results = self._merge_legacy(results, await self._search_legacy(query_embedding, user_id, agent_id, limit), limit)
+            if not results:
                 logger.info(f"No matching RAG entries for user_id: {user_id}, agent_id: {agent_id}")
-                return []
-            results = []
-            for r in response.data:
-                content = await self._get_file_content(r["file_path"])
-                results.append({"content": content, "metadata": r["metadata"]})
-            return results
         except Exception as e:
             logger.error(f"Search failed: {e}")
-            return []
+            results = []
+        return (results, query_embedding) if return_embedding else results
+
+    async def previous_versions(self, user_id, agent_id, filenames, batch_size=50):
+        """Stored rows for these filenames of an agent: filename -> [{"id", "file_path", "content_hash"}]."""
+        versions = {}
+        filenames = list(dict.fromkeys(filenames))
+        for start in range(0, len(filenames), batch_size):
+            response = await self.db.execute(
+                self.client.table("rag_metadata").select("id, file_path, content_hash, metadata")
+                .eq("user_id", user_id).eq("agent_id", agent_id)
+                .in_("metadata->>filename", filenames[start:start + batch_size])
+            )
+            for r in response.data:
+                versions.setdefault(r["metadata"].get("filename"), []).append(
+                    {"id": r["id"], "file_path": r["file_path"], "content_hash": r.get("content_hash")}
+                )
+        return versions
+
+    async def chunk_embeddings(self, rag_ids, page_size=1000):
+        """Embeddings of the stored chunks of these files, keyed by chunk_hash of their text."""
+        embeddings = {}
+        if not rag_ids:
+            return embeddings
+        loop = asyncio.get_event_loop()
+        offset = 0
+        while True:
+            response = await self.db.execute(
+                self.client.table("rag_chunks").select("content, embedding").in_("rag_id", rag_ids)
+                .order("id").range(offset, offset + page_size - 1)
+            )
+            # Hashing and parsing a page of chunks is CPU work, so it runs on a worker thread
+            embeddings.update(await loop.run_in_executor(None, self._keyed_embeddings, response.data))
+            if len(response.data) < page_size:
+                return embeddings
+            offset += page_size
+
+    @staticmethod
+    def _keyed_embeddings(rows):
+        # pgvector values come back from Supabase as strings
+        return {chunk_hash(r["content"]): json.loads(r["embedding"]) if isinstance(r["embedding"], str) else r["embedding"]
+                for r in rows}
+
+    @staticmethod
+    def _file_embedding(chunk_embeddings):
+        embedding = np.mean(np.array(chunk_embeddings), axis=0)
+        return (embedding / (np.linalg.norm(embedding) or 1.0)).tolist()
+
+    async def add_many(self, documents, user_id, metadata_batch_size=50, known_embeddings=None):
+        """Store several extracted documents: every chunk embedded in large batches, rows bulk-inserted.
+
+        documents are {"file_path", "content", "metadata"} plus an optional
+        "content_hash" of the original file and optional "chunks" already
+        produced by hashed_chunks (as DocumentExtractor returns them); other
+        documents are chunked on a worker thread. Returns one {"rag_id", "chunks",
+        "embedded"} or {"error"} per document, in order; a document that fails
+        doesn't stop the others. Chunks whose text hash is in known_embeddings
+        (from chunk_embeddings) reuse that embedding instead of being embedded
+        again. rag_metadata rows (which carry the full text) go in
+        metadata_batch_size at a time, chunks in insert_batch_size.
+        """
+        known_embeddings = known_embeddings or {}
+        loop = asyncio.get_event_loop()
+        results = [None] * len(documents)
+        pending = []  # (position, document, chunks)
+        for i, document in enumerate(documents):
+            chunks = document.get("chunks")
+            if chunks is None:
+                chunks = await loop.run_in_executor(None, hashed_chunks, document["content"], self.chunk_size, self.chunk_overlap)
+            if chunks:
+                pending.append((i, document, chunks))
+            else:
+                results[i] = {"error": "No text could be extracted from the file"}
+        texts = [c["content"] for _, _, chunks in pending for c in chunks]
+        embeddings = [known_embeddings.get(c["hash"]) for _, _, chunks in pending for c in chunks]
+        missing = [n for n, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            for n, embedding in zip(missing, await self._embed_batch([texts[n] for n in missing])):
+                embeddings[n] = embedding
+        self.chunks_embedded += len(missing)
+        self.chunks_reused += len(embeddings) - len(missing)
+        missing = set(missing)
+
+        grouped = []
+        offset = 0
+        for _, _, chunks in pending:
+            grouped.append(embeddings[offset:offset + len(chunks)])
+            offset += len(chunks)
+        # The file row keeps a single embedding (mean of its chunks) for the legacy match_rag_files RPC
+        file_embeddings = await loop.run_in_executor(None, lambda: [self._file_embedding(e) for e in grouped])
 
-    async def add(self, file_content, user_id, metadata, file_path):
-        embedding = await self._get_embedding(file_content)
-        response = self.client.table("rag_metadata").insert({
+        files = {}  # file_path -> (position, document, chunks, embeddings, metadata, chunks embedded)
+        rows = []
+        offset = 0
+        for (i, document, chunks), chunk_embeddings, file_embedding in zip(pending, grouped, file_embeddings):
+            embedded = sum(1 for n in range(offset, offset + len(chunks)) if n in missing)
+            offset += len(chunks)
+            metadata = {**document["metadata"], "chunk_count": len(chunks)}
+            files[document["file_path"]] = (i, document, chunks, chunk_embeddings, metadata, embedded)
+            rows.append({
+                "user_id": user_id,
+                "agent_id": metadata.get("agent_id"),
+                "file_path": document["file_path"],
+                "metadata": metadata,
+                "embedding": file_embedding,
+                "content": document["content"],
+                "content_hash": document.get("content_hash")
+            })
+
+        rag_ids = {}
+        for start in range(0, len(rows), metadata_batch_size):
+            batch = rows[start:start + metadata_batch_size]
+            try:
+                response = await self.db.execute(self.client.table("rag_metadata").insert(batch))
+                rag_ids.update({r["file_path"]: r["id"] for r in response.data})
+            except Exception as e:
+                logger.error(f"Storing {len(batch)} RAG file rows failed: {e}")
+            for row in batch:
+                if row["file_path"] not in rag_ids:
+                    results[files[row["file_path"]][0]] = {"error": "Failed to store the file record"}
+
+        chunk_rows = [{
+            "rag_id": rag_ids[file_path],
             "user_id": user_id,
             "agent_id": metadata.get("agent_id"),
             "file_path": file_path,
-            "metadata": metadata,
+            "chunk_index": c["index"],
+            "start_offset": c["start"],
+            "end_offset": c["end"],
+            "content": c["content"],
             "embedding": embedding
-        }).execute()
-        return response.data[0]["id"] if response.data else None
+        } for file_path, (_, _, chunks, chunk_embeddings, metadata, _) in files.items() if file_path in rag_ids
+            for c, embedding in zip(chunks, chunk_embeddings)]
+        inserted = {}
+        failed = set()
+        for start in range(0, len(chunk_rows), self.insert_batch_size):
+            batch = chunk_rows[start:start + self.insert_batch_size]
+            try:
+                response = await self.db.execute(self.client.table("rag_chunks").insert(batch))
+                for r in response.data:
+                    inserted.setdefault(r["file_path"], []).append(r)
+            except Exception as e:
+                logger.error(f"Storing {len(batch)} RAG chunks failed: {e}")
+                failed.update(r["file_path"] for r in batch)
+        if failed:
+            # Don't leave files half-chunked: drop their rows (chunks cascade) and report them as failed
+            try:
+                await self.db.execute(self.client.table("rag_metadata").delete().in_("id", [rag_ids[p] for p in failed]))
+            except Exception as e:
+                logger.error(f"Cleaning up partially stored RAG files failed: {e}")
+
+        for file_path, rag_id in rag_ids.items():
+            i, document, chunks, chunk_embeddings, metadata, embedded = files[file_path]
+            if file_path in failed:
+                results[i] = {"error": "Failed to store the file's chunks"}
+                continue
+            self.content_cache.set(file_path, document["content"])
+            # The insert echoes embeddings back as pgvector strings; index the vectors already in memory instead
+            indexed = [{**r, "metadata": metadata, "embedding": chunk_embeddings[r["chunk_index"]]}
+                       for r in inserted.get(file_path, [])]
+            if self.local_index is not None:
+                await self.local_index.add(user_id, metadata.get("agent_id"), indexed)
+            if self.lexical_index is not None:
+                await self.lexical_index.add(user_id, metadata.get("agent_id"), indexed)
+            results[i] = {"rag_id": rag_id, "chunks": len(chunks), "embedded": embedded}
+            logger.info(f"Stored {len(chunks)} chunks ({embedded} newly embedded) for {file_path}")
+        return results
+
+# Created once at startup and shared by every endpoint; None until the model is loaded
+shared_vector_store: Optional[SupabaseVectorStore] = None
 
-async def call_llm(llm_type, api_key, messages):
+def get_vector_store():
+    if shared_vector_store is None:
+        raise HTTPException(status_code=503, detail="Embedding model is still loading")
+    return shared_vector_store
+
+@app.on_event("startup")
+async def start_http_client():
+    await http_client.start()
+
+@app.on_event("startup")
+async def load_vector_store():
+    global shared_vector_store
     start = time.time()
+    loop = asyncio.get_event_loop()
+    embedder = await loop.run_in_executor(None, SentenceTransformer, embedding_model_name)
+    batcher = EmbeddingBatcher(embedder, max_batch_size=embed_max_batch_size, batch_window_ms=embed_batch_window_ms)
+    batcher.start()
+    # Warm up so the first real query doesn't pay for lazy initialization
+    await batcher.encode("warmup")
+    vector_store = SupabaseVectorStore(
+        supabase_client, db, batcher, rag_chunk_size, rag_chunk_overlap,
+        content_cache_bytes=rag_content_cache_mb * 1024 * 1024,
+        fetch_concurrency=rag_fetch_concurrency, fetch_timeout=rag_fetch_timeout,
+        embedding_cache_size=embedding_cache_size, embedding_cache_ttl=embedding_cache_ttl,
+        local_index=LocalVectorIndex(local_index_ann_threshold) if retrieval_backend == "local" else None,
+        lexical_index=LexicalIndex() if lexical_index_enabled else None,
+        lexical_shortcut_confidence=lexical_shortcut_confidence if lexical_shortcut else None,
+        lexical_min_confidence=lexical_min_confidence
+    )
+    if vector_store.local_index is not None or vector_store.lexical_index is not None:
+        await vector_store.load_indexes()
+    vector_store.embedding_writer.start()
+    # Only publish once fully loaded so /ready stays 503 until then
+    shared_vector_store = vector_store
+    logger.info(f"Loaded embedding model {embedding_model_name} in {time.time() - start:.2f}s")
+
+@app.on_event("shutdown")
+async def shutdown_db():
+    if shared_vector_store is not None:
+        await shared_vector_store.embedding_writer.stop()
+        await shared_vector_store.batcher.stop()
+    await zoho_tokens.close()
+    db.shutdown()
+    document_extractor.shutdown()
+    await http_client.close()
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "supabase": db.stats(),
+        "http": http_client.stats(),
+        "zoho_tokens": zoho_tokens.stats(),
+        "zoho_contacts": zoho_contacts.stats(),
+        "ticket_queue": ticket_queue.stats(),
+        "agent_configs": agent_configs.stats(),
+        "answer_cache": answer_cache.stats(),
+        "history": history_manager.stats(),
+        "prompt_cache": prompt_cache_stats.stats(),
+        "llm": llm_router.stats(),
+        "sessions": sessions.stats(),
+        "extraction": document_extractor.stats(),
+        "vector_store": shared_vector_store.stats() if shared_vector_store is not None else None
+    }
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    if shared_vector_store is None:
+        raise HTTPException(status_code=503, detail="Embedding model is still loading")
+    return {"status": "ready"}
+
+def build_llm_request(llm_type, api_key, messages, stream=False):
     urls = {
         "deepseek": "https://api.deepseek.com/chat/completions",
         "gpt": "https://api.openai.com/v1/chat/completions",
@@ -126,26 +696,177 @@ async def call_llm(llm_type, api_key, messages):
         payload = {
             "contents": [{"parts": [{"text": f"{system_prompt}\n\n{conversation}"}]}]
         }
-        url += f"?key={api_key}"
+        if stream:
+            url = url.replace(":generateContent", ":streamGenerateContent") + "?alt=sse&"
+        else:
+            url += "?"
+        url += f"key={api_key}"
     else:
         payload = {"model": model, "messages": messages, "temperature": 0.7}
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload) as resp:
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    raise HTTPException(status_code=resp.status, detail=f"LLM API error: {error_text}")
-                data = await resp.json()
-                if llm_type == "gemini":
-                    result = data["candidates"][0]["content"]["parts"][0]["text"]
-                else:
-                    result = data["choices"][0]["message"]["content"]
-                logger.info(f"{llm_type} took {time.time() - start:.2f}s")
-                return result
-    except Exception as e:
-        logger.error(f"LLM call failed: {e}")
-        raise HTTPException(status_code=500, detail=f"LLM call failed: {str(e)}")
+        if stream:
+            payload["stream"] = True
+            if llm_type in ("deepseek", "gpt"):
+                payload["stream_options"] = {"include_usage": True}
+    return url, headers, payload
+
+prompt_cache_stats = PromptCacheStats()
+
+def record_prompt_usage(llm_type, usage):
+    if usage is None:
+        return
+    prompt_tokens, cached_tokens = usage
+    prompt_cache_stats.record(llm_type, prompt_tokens, cached_tokens)
+    logger.info(f"{llm_type} prompt tokens: {prompt_tokens}, cached: {cached_tokens}")
+
+def llm_error(resp, error_text):
+    retry_after = resp.headers.get("Retry-After")
+    return HTTPException(status_code=resp.status, detail=f"LLM API error: {error_text}",
+                         headers={"Retry-After": retry_after} if retry_after else None)
+
+async def call_llm(llm_type, api_key, messages, deadlines=None):
+    """One completion from one provider. Errors propagate; llm_router maps them for clients."""
+    start = time.time()
+    url, headers, payload = build_llm_request(llm_type, api_key, messages)
+    deadlines = deadlines or llm_deadlines.get(llm_type, llm_default_deadlines)
+    timeout = aiohttp.ClientTimeout(total=deadlines["total"], sock_connect=deadlines["connect"])
+    async with http_client.session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
+        if resp.status != 200:
+            raise llm_error(resp, await resp.text())
+        data = await resp.json()
+        if llm_type == "gemini":
+            result = data["candidates"][0]["content"]["parts"][0]["text"]
+        else:
+            result = data["choices"][0]["message"]["content"]
+        record_prompt_usage(llm_type, prompt_usage(llm_type, data))
+        logger.info(f"{llm_type} took {time.time() - start:.2f}s")
+        return result
+
+async def call_llm_stream(llm_type, api_key, messages, deadlines=None):
+    """Yield response text as it is generated, via the providers' SSE streaming APIs."""
+    start = time.time()
+    url, headers, payload = build_llm_request(llm_type, api_key, messages, stream=True)
+    deadlines = deadlines or llm_deadlines.get(llm_type, llm_default_deadlines)
+    # sock_read bounds the wait for the first chunk and any stall between chunks
+    timeout = aiohttp.ClientTimeout(total=deadlines["total"], sock_connect=deadlines["connect"], sock_read=deadlines["first_byte"])
+    first_token_at = None
+    usage = None
+    async with http_client.session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
+        if resp.status != 200:
+            raise llm_error(resp, await resp.text())
+        async for raw_line in resp.content:
+            line = raw_line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            # Usage arrives on the final chunk (cumulative on every chunk for Gemini)
+            usage = prompt_usage(llm_type, event) or usage
+            if llm_type == "gemini":
+                parts = (event.get("candidates") or [{}])[0].get("content", {}).get("parts", [])
+                text = "".join(p.get("text", "") for p in parts)
+            else:
+                text = (event.get("choices") or [{}])[0].get("delta", {}).get("content") or ""
+            if text:
+                if first_token_at is None:
+                    first_token_at = time.time()
+                    logger.info(f"{llm_type} first token after {first_token_at - start:.2f}s")
+                yield text
+    record_prompt_usage(llm_type, usage)
+    logger.info(f"{llm_type} stream took {time.time() - start:.2f}s")
+
+async def summarize_history(llm_type, api_key, previous_summary, turns):
+    """Fold older chat turns (and the summary so far) into a short summary for the history manager."""
+    transcript = "\n".join(f"{m.get('role', 'user').capitalize()}: {m.get('content', '')}" for m in turns)
+    if previous_summary:
+        transcript = f"Summary so far: {previous_summary}\n\n{transcript}"
+    messages = [
+        {"role": "system", "content": (
+            f"Summarize this support conversation in at most {history_summary_tokens * 3 // 4} words. "
+            "Keep the customer's setup, problems, requested language, and anything already promised or answered."
+        )},
+        {"role": "user", "content": transcript}
+    ]
+    return (await llm_router.complete([(llm_type, api_key)], messages)).strip()
+
+llm_admission = AdmissionController(llm_max_in_flight, llm_max_queue, llm_queue_timeout, limits=llm_max_in_flight_by_provider)
+llm_router = LLMRouter(
+    call_llm, call_llm_stream, llm_deadlines, llm_default_deadlines, llm_breaker_settings,
+    hedging=llm_hedging, hedge_percentile=llm_hedge_percentile, hedge_min_delay=llm_hedge_min_delay,
+    admission=llm_admission
+)
+
+def agent_route(llm_type, api_key, fallbacks=None):
+    """The (llm_type, api_key) chain llm_router tries for an agent: its own provider, then its fallbacks."""
+    route = [(llm_type, api_key)]
+    for fallback in fallbacks or []:
+        target = (fallback.get("llm_type"), fallback.get("api_key"))
+        if all(target) and target not in route:
+            route.append(target)
+    return route
+
+history_manager = HistoryManager(
+    summarize_history, prompt_token_budgets, prompt_token_budget,
+    history_summary_tokens, history_summary_cache_size, history_summary_cache_ttl
+)
+
+NAME_PREFIX = re.compile(r"^(assistant|agent|\w+):(\s+)?", flags=re.IGNORECASE)
+
+async def sanitize_stream(tokens):
+    """Strip a leading 'assistant:' / 'Name:' prefix from a token stream, like the non-streaming path.
+
+    Leading tokens are held back only until it's clear whether they form such a prefix.
+    """
+    buffer = ""
+    started = False
+    async for token in tokens:
+        if started:
+            yield token
+            continue
+        buffer += token
+        text = buffer.lstrip()
+        if re.fullmatch(r"\w*", text):
+            continue
+        text = NAME_PREFIX.sub("", text).lstrip()
+        if not text:
+            continue
+        started = True
+        yield text
+    if not started:
+        text = NAME_PREFIX.sub("", buffer.strip()).strip()
+        if text:
+            yield text
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def stream_agent_response(route, messages, agent_name, build_result, on_complete=None):
+    """Stream an agent's reply as Server-Sent Events.
+
+    Emits "token" events with text deltas, then a "done" event carrying
+    build_result(formatted_response) - the same body the non-streaming endpoint returns.
+    on_complete(sanitized_response) is awaited once the full reply has streamed.
+    """
+    async def events():
+        parts = []
+        try:
+            async for token in sanitize_stream(llm_router.stream(route, messages)):
+                parts.append(token)
+                yield sse_event({"token": token}, "token")
+        except Exception as e:
+            logger.error(f"LLM stream failed: {e}")
+            yield sse_event({"detail": f"LLM call failed: {getattr(e, 'detail', str(e))}"}, "error")
+            return
+        sanitized_response = "".join(parts).strip()
+        if sanitized_response and on_complete is not None:
+            await on_complete(sanitized_response)
+        sanitized_response = sanitized_response or "Sorry, I didn’t catch that. How can I assist you?"
+        formatted_response = f"{agent_name}: {sanitized_response}"
+        logger.info(f"Streamed response: {formatted_response}")
+        yield sse_event(build_result(formatted_response), "done")
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 class AgentConfig(BaseModel):
     id: Optional[str] = None
@@ -167,6 +888,10 @@ class AgentConfig(BaseModel):
     helpdesk_subdomain: str = ""
     create_tickets: bool = False
     department: str = ""
+    answer_cache: bool = False
+    context_token_budget: Optional[int] = None
+    context_min_similarity: Optional[float] = None
+    fallbacks: List[dict] = []  # [{"llm_type": ..., "api_key": ...}] tried in order when llm_type fails or is slow
 
 class ChatRequest(BaseModel):
     user_id: str
@@ -178,6 +903,8 @@ class ChatRequest(BaseModel):
     customer_name: Optional[str] = None
     language: str = "English"
     department: Optional[str] = None  # Added to allow department selection
+    stream: bool = False
+    conversation_id: Optional[str] = None
 
 class DeleteRagRequest(BaseModel):
     user_id: str
@@ -192,17 +919,20 @@ class WidgetRequest(BaseModel):
     customer_email: Optional[str] = None
     customer_name: Optional[str] = None
     language: str = "English"
+    stream: bool = False
+    conversation_id: Optional[str] = None
 
 class TicketRequest(BaseModel):
     user_id: str
     agent_id: str
-    message: str
-    response: str
+    message: str = ""
+    response: str = ""
     platform: str
     department_id: Optional[str] = None
     customer_email: Optional[str] = None
     customer_name: Optional[str] = None
     agent_name: Optional[str] = None
+    conversation_id: Optional[str] = None
 
 class ContactSetupRequest(BaseModel):
     user_id: str
@@ -210,28 +940,43 @@ class ContactSetupRequest(BaseModel):
     name: str
     email: str
 
-async def get_zoho_access_token(client_id: str, client_secret: str, refresh_token: str):
+async def fetch_zoho_access_token(client_id: str, client_secret: str, refresh_token: str):
     url = "https://accounts.zoho.in/oauth/v2/token"
     payload = {
         "grant_type": "refresh_token",
         "client_id": client_id,
         "client_secret": client_secret,
         "refresh_token": refresh_token,
-        "scope": "Desk.tickets.ALL,Desk.contacts.CREATE"
+        "scope": "Desk.tickets.ALL,Desk.contacts.CREATE,Desk.contacts.READ"
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=payload) as resp:
-            response_text = await resp.text()
-            logger.info(f"Zoho token refresh response: status={resp.status}, body={response_text}")
-            if resp.status != 200:
-                logger.error(f"Failed to refresh Zoho token: {response_text}")
-                raise HTTPException(status_code=resp.status, detail=f"Failed to refresh Zoho token: {response_text}")
-            data = await resp.json()
-            if "access_token" not in data:
-                logger.error(f"No 'access_token' in Zoho response: {data}")
-                raise HTTPException(status_code=400, detail=f"Invalid Zoho response: {data}")
-            logger.info(f"Generated access_token: {data['access_token'][:10]}... (scope: {data.get('scope', 'unknown')})")
-            return data["access_token"]
+    async with http_client.session.post(url, data=payload) as resp:
+        response_text = await resp.text()
+        logger.info(f"Zoho token refresh response: status={resp.status}, body={response_text}")
+        if resp.status != 200:
+            logger.error(f"Failed to refresh Zoho token: {response_text}")
+            raise HTTPException(status_code=resp.status, detail=f"Failed to refresh Zoho token: {response_text}")
+        data = await resp.json()
+        if "access_token" not in data:
+            logger.error(f"No 'access_token' in Zoho response: {data}")
+            raise HTTPException(status_code=400, detail=f"Invalid Zoho response: {data}")
+        logger.info(f"Generated access_token: {data['access_token'][:10]}... (scope: {data.get('scope', 'unknown')})")
+        return data["access_token"], int(data.get("expires_in", 3600))
+
+# Zoho access tokens last an hour; reuse them per agent credentials instead of refreshing per ticket
+zoho_tokens = RefreshingTokenCache(fetch_zoho_access_token, refresh_margin=zoho_token_refresh_margin)
+
+async def with_zoho_token(client_id: str, client_secret: str, refresh_token: str, call):
+    """Run call(access_token); if Zoho answers 401 (token revoked or rotated early), retry once with a fresh token."""
+    key = (client_id, client_secret, refresh_token)
+    access_token = await zoho_tokens.get(key)
+    try:
+        return await call(access_token)
+    except HTTPException as e:
+        if e.status_code != 401:
+            raise
+        logger.info("Zoho rejected the cached access token; refreshing it and retrying")
+        zoho_tokens.invalidate(key, access_token)
+        return await call(await zoho_tokens.get(key))
 
 async def create_zoho_contact(access_token: str, org_id: str, email: str, name: str):
     url = "https://desk.zoho.in/api/v1/contacts"
@@ -245,26 +990,67 @@ async def create_zoho_contact(access_token: str, org_id: str, email: str, name:
         "lastName": name.split()[-1] if " " in name else name,
         "firstName": name.split()[0] if " " in name else ""
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=payload) as resp:
-            logger.info(f"Creating contact: URL={url}, Headers={headers}, Payload={payload}")
-            if resp.status in [200, 201]:
-                contact = await resp.json()
-                contact_id = contact["id"]
-                logger.info(f"Created new contact: {contact_id} for email: {email}")
-                return contact_id
-            else:
-                error_text = await resp.text()
-                logger.error(f"Contact creation failed: status={resp.status}, error={error_text}")
-                raise HTTPException(status_code=resp.status, detail=f"Contact creation failed: {error_text}")
+    async with http_client.session.post(url, headers=headers, json=payload) as resp:
+        logger.info(f"Creating contact: URL={url}, Headers={headers}, Payload={payload}")
+        if resp.status in [200, 201]:
+            contact = await resp.json()
+            contact_id = contact["id"]
+            logger.info(f"Created new contact: {contact_id} for email: {email}")
+            return contact_id
+        else:
+            error_text = await resp.text()
+            logger.error(f"Contact creation failed: status={resp.status}, error={error_text}")
+            raise HTTPException(status_code=resp.status, detail=f"Contact creation failed: {error_text}")
+
+async def find_zoho_contact(access_token: str, org_id: str, email: str):
+    url = "https://desk.zoho.in/api/v1/contacts/search"
+    headers = {
+        "Authorization": f"Zoho-oauthtoken {access_token}",
+        "orgId": org_id
+    }
+    async with http_client.session.get(url, headers=headers, params={"email": email, "limit": 1}) as resp:
+        if resp.status == 204:
+            return None
+        if resp.status != 200:
+            error_text = await resp.text()
+            logger.error(f"Contact search failed: status={resp.status}, error={error_text}")
+            raise HTTPException(status_code=resp.status, detail=f"Contact search failed: {error_text}")
+        contacts = (await resp.json()).get("data") or []
+        return contacts[0]["id"] if contacts else None
+
+# Zoho contact IDs keyed by (org_id, email) so returning customers don't trigger a search or create
+zoho_contacts = LRUCache(zoho_contact_cache_size, ttl=zoho_contact_cache_ttl)
+
+async def resolve_zoho_contact(access_token: str, org_id: str, email: str, name: str):
+    key = (org_id, email.lower())
+    contact_id = zoho_contacts.get(key)
+    if contact_id is not None:
+        return contact_id
+    try:
+        contact_id = await find_zoho_contact(access_token, org_id, email)
+    except Exception as e:
+        if getattr(e, "status_code", None) == 401:
+            raise  # a stale token fails the create too; let the caller refresh it
+        # e.g. a refresh token minted without Desk.contacts.READ; creating the contact still works
+        logger.error(f"Contact search failed for {email}, creating the contact instead: {getattr(e, 'detail', e)}")
+        contact_id = None
+    if contact_id is not None:
+        logger.info(f"Found existing contact: {contact_id} for email: {email}")
+    else:
+        contact_id = await create_zoho_contact(access_token, org_id, email, name)
+    zoho_contacts.set(key, contact_id)
+    return contact_id
+
+def forget_zoho_contact(org_id: str, email: str):
+    zoho_contacts.pop((org_id, email.lower()))
 
 @app.post("/setup_contact")
 async def setup_contact(request: ContactSetupRequest):
     try:
         if request.agent_id:
-            agent_response = supabase_client.table("agents").select(
+            agent_response = await db.execute(supabase_client.table("agents").select(
                 "helpdesk_client_id, helpdesk_client_secret, helpdesk_refresh_token, helpdesk_org_id, helpdesk_platform, name"
-            ).eq("id", request.agent_id).eq("user_id", request.user_id).execute()
+            ).eq("id", request.agent_id).eq("user_id", request.user_id))
             if not agent_response.data:
                 raise HTTPException(status_code=404, detail="Agent not found")
             agent_data = agent_response.data[0]
@@ -277,21 +1063,74 @@ async def setup_contact(request: ContactSetupRequest):
             refresh_token = agent_data.get("helpdesk_refresh_token")
             org_id = agent_data.get("helpdesk_org_id")
             
-            access_token = await get_zoho_access_token(client_id, client_secret, refresh_token)
-            contact_id = await create_zoho_contact(access_token, org_id, request.email, request.name)
+            contact_id = await with_zoho_token(
+                client_id, client_secret, refresh_token,
+                lambda access_token: resolve_zoho_contact(access_token, org_id, request.email, request.name)
+            )
             return {"contact_id": contact_id}
         return {"contact_id": None}
     except Exception as e:
         logger.error(f"Contact setup failed: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to set up contact: {str(e)}")
 
+# Server-side conversations: clients send a conversation_id and only the new message
+sessions = (
+    SupabaseSessionStore(db, supabase_client) if session_store == "supabase"
+    else MemorySessionStore(session_max_conversations, session_ttl)
+)
+
+async def open_conversation(user_id, conversation_id, history):
+    """Return (conversation_id, history, reset) for a chat request.
+
+    A known conversation_id yields its stored turns, and a request without
+    one starts a new conversation. Clients that send their whole history are
+    served from it without a session, also when their conversation_id is
+    no longer known (expired, evicted, lost in a restart or held by another
+    worker). An unknown id without a history gets an empty one and
+    reset=True, which tells the client to send its history from then on.
+    """
+    if conversation_id:
+        conversation = await sessions.get(conversation_id)
+        if conversation is not None and conversation["user_id"] == user_id:
+            return conversation_id, conversation["turns"], False
+        if history:
+            logger.warning(f"Conversation {conversation_id} not found; continuing from the history the client sent")
+            return None, history, False
+        logger.warning(f"Conversation {conversation_id} not found; asking the client to resend its history")
+        return None, [], True
+    if history:
+        return None, history, False
+    return await sessions.create(user_id), [], False
+
+async def record_turns(conversation_id, message, response):
+    if conversation_id is None:
+        return
+    try:
+        await sessions.append(conversation_id, [{"role": "user", "content": message}, {"role": "assistant", "content": response}])
+    except Exception as e:
+        logger.error(f"Failed to record turns for conversation {conversation_id}: {e}")
+
+def conversation_transcript(turns):
+    return "\n".join(f"{'User' if t['role'] == 'user' else 'Assistant'}: {t['content']}" for t in turns)
+
+def build_rag_context(rag_context, llm_type, token_budget=None, min_similarity=None):
+    """Assemble search hits into prompt context, using the agent's overrides where set."""
+    budget = token_budget or context_token_budgets.get(llm_type, context_token_budget)
+    cutoff = context_min_similarity if min_similarity is None else min_similarity
+    rag_text, report = assemble_context(rag_context, llm_type, budget, cutoff)
+    logger.info(f"Assembled context: {report}")
+    return rag_text or "No relevant data found.", report
+
 @app.post("/chat")
 async def chat(request: ChatRequest):
-    vector_store = SupabaseVectorStore(supabase_client)
+    vector_store = get_vector_store()
     normalized_message = request.message.lower().strip()
     
     responses = []
     rag_text = ""
+    context_report = None
+    conversation_id = None
+    conversation_reset = False
     try:
         if request.mode == "single_rag":
             # Use department to select agent if provided, otherwise take first agent
@@ -303,45 +1142,37 @@ async def chat(request: ChatRequest):
                 agent = request.agents[0]  # Fallback to first agent if no department specified
             
             company_name = agent.company if agent.company else "CogniCrew"
+            conversation_id, history, conversation_reset = await open_conversation(request.user_id, request.conversation_id, request.history)
             
-            rag_task = vector_store.search(normalized_message, request.user_id, agent_id=agent.id)
-            prompt = f"""
-            You’re {agent.name} at {company_name}, in the {agent.department} department. Your persona: {agent.info}.
-            - Do NOT prepend your name, 'assistant:', 'agent:', or any role-based prefix to your response; provide only the raw message content with no labels.
-            - If the user asks "What is your name?" "Who are you?" or similar, respond naturally (e.g., "I’m {agent.name}! How can I help you today?").
-            - Start by responding in {request.language}.
-            - If the user says "Switch to [language]" or similar (e.g., "Use Spanish"), detect the requested language (even with typos), switch to it for all future responses, and confirm: "Switched to [language]!"
-            - If the conversation history is empty (length 0), it’s the first message—end with: "By the way, need a different language? Just say 'Switch to Spanish,' 'Switch to French,' etc."—otherwise, do not include this unless the user mentions languages.
-            - Respond to casual greetings creatively and variably only if the input is clearly a greeting and not a question:
-              - "Hello" or "Hi": "Hi there! What’s on your mind today?"
-              - "Hey" or "Heya": "Heya! Good to chat—what can I do for you?"
-              - "How’s it going": "Hey, doing great—how about you? What’s up?"
-            - For any input resembling a question (e.g., starts with 'what', 'how', 'why', or contains '?'), answer directly without a greeting unless it’s the first message.
-            - For anything about {company_name}:
-              1. Use this data ONLY: {{rag_text}}. Quote it exactly—no paraphrasing, no guessing.
-              2. Guess their setup or pain points based on prior messages if available.
-              3. Give the fix or info naturally, like you’re recalling it.
-              4. If the data mentions packages, upsell once—explain the perk, ask if they’re interested, then drop it unless they bring it up again.
-            - If no data: Say: “Sorry, I don’t have specific info on that. Check {company_name}’s site or let me know how else I can help!”
-            - Off-topic? Say: “I’m here to assist with any {company_name}-related questions or support needs. How can I help you today?”—keep it simple unless it’s the first message.
-            - Be friendly, helpful, and on-brand—never bash {company_name}.
-            - Use the conversation history to stay consistent, vary responses, and avoid repetition unless necessary.
-            """
-            rag_context, _ = await asyncio.gather(rag_task, asyncio.sleep(0))
-            rag_text = "\n".join([r["content"] for r in rag_context]) if rag_context else "No relevant data found."
-            prompt = prompt.replace("{rag_text}", rag_text)
+            rag_context = await vector_store.search(normalized_message, request.user_id, agent_id=agent.id, limit=context_candidates)
+            rag_text, context_report = build_rag_context(rag_context, agent.llm_type, agent.context_token_budget, agent.context_min_similarity)
+            prompt = agent_prefix(agent.name, company_name, agent.department, agent.info)
             
-            messages = [{"role": "system", "content": prompt}] + request.history + [{"role": "user", "content": request.message}]
-            raw_response = await call_llm(agent.llm_type, agent.api_key, messages)
+            messages = await history_manager.build_messages(
+                agent.llm_type, agent.api_key, prompt, history, request.message,
+                conversation_key=conversation_id, context=session_details(request.language, rag_text)
+            )
+            if request.stream:
+                return stream_agent_response(
+                    agent_route(agent.llm_type, agent.api_key, agent.fallbacks), messages, agent.name,
+                    lambda formatted: {
+                        "responses": [{"agent": agent.name, "response": formatted, "avatar_url": agent.avatar_url}],
+                        "rag_context": rag_text,
+                        "context": context_report,
+                        "conversation_id": conversation_id,
+                        "conversation_reset": conversation_reset
+                    },
+                    lambda sanitized: record_turns(conversation_id, request.message, f"{agent.name}: {sanitized}")
+                )
+            raw_response = await llm_router.complete(agent_route(agent.llm_type, agent.api_key, agent.fallbacks), messages)
             
-            sanitized_response = re.sub(
-                r"^(assistant|agent|\w+):(\s+)?", "", raw_response.strip(), flags=re.IGNORECASE
-            ).strip()
+            sanitized_response = NAME_PREFIX.sub("", raw_response.strip()).strip()
             
             if not sanitized_response:
                 sanitized_response = "Sorry, I didn’t catch that. How can I assist you?"
             
             formatted_response = f"{agent.name}: {sanitized_response}"
+            await record_turns(conversation_id, request.message, formatted_response)
             
             responses.append({
                 "agent": agent.name,
@@ -353,41 +1184,224 @@ async def chat(request: ChatRequest):
         logger.info(f"Formatted response: {formatted_response}")
         logger.info(f"Query: {normalized_message}, Agent: {agent.name} (ID: {agent.id}), RAG: {rag_text}, Language: {request.language}")
         logger.info(f"Chat response: {responses}")
-        return {"responses": responses, "rag_context": rag_text}
+        return {"responses": responses, "rag_context": rag_text, "context": context_report,
+                "conversation_id": conversation_id, "conversation_reset": conversation_reset}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat failed: {e}")
         raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
 
+# Text extraction and chunking run in worker processes: each document is parsed once, under its own time and CPU limits
+document_extractor = DocumentExtractor(rag_extract_workers, rag_extract_timeout, rag_extract_cpu_seconds,
+                                       rag_chunk_size, rag_chunk_overlap)
+rag_max_file_bytes = 10 * 1024 * 1024
+
+async def remove_rag_objects(file_paths):
+    """Best-effort removal of Storage objects no rag_metadata row refers to any more."""
+    try:
+        await db.run(supabase_client.storage.from_("ragfiles").remove, file_paths, timeout=rag_storage_timeout)
+    except Exception as e:
+        logger.error(f"Removing {len(file_paths)} orphaned RAG objects failed: {e}")
+
+async def ingest_documents(user_id, agent_id, documents):
+    """Store (filename, bytes or path) documents for an agent; returns a result per document, in order.
+
+    A document is identified by its filename within the agent. If its
+    content hash matches what's stored it is skipped ("unchanged") without
+    being uploaded, extracted or embedded. Otherwise the new version is
+    stored with the embeddings of its unchanged chunks reused, and the
+    previous versions' rows and Storage objects are retired once it's in.
+    Each original uploads to Storage while its text is extracted and
+    embedded; rows whose upload failed are dropped again, and objects whose
+    document didn't make it into the database are removed. A result is
+    {"filename", "status": "stored", "memory_id", "chunks", "embedded"},
+    {"filename", "status": "unchanged", "memory_id"}, or status "invalid"
+    (the document itself can't be used) or "failed" with an "error".
+    """
+    vector_store = get_vector_store()
+    loop = asyncio.get_event_loop()
+    upload_date = datetime.now().isoformat()
+    hashes = await asyncio.gather(*(loop.run_in_executor(None, content_hash, source) for _, source in documents))
+    versions = await vector_store.previous_versions(user_id, agent_id, [filename for filename, _ in documents])
+    results = [None] * len(documents)
+    changed = []
+    seen = set()
+    for i, (filename, _) in enumerate(documents):
+        current = next((v for v in versions.get(filename, []) if v["content_hash"] == hashes[i]), None)
+        if filename in seen:
+            results[i] = {"filename": filename, "status": "invalid", "error": "Duplicate file name in this upload"}
+        elif current is not None:
+            results[i] = {"filename": filename, "status": "unchanged", "memory_id": current["id"]}
+        else:
+            changed.append(i)
+        seen.add(filename)
+
+    paths = {i: f"{user_id}/{agent_id}/{upload_date}_{i}_{documents[i][0].replace('/', '_')}" for i in changed}
+    # A few uploads at a time, so queued ones don't run into the Supabase call timeout
+    upload_slots = asyncio.Semaphore(rag_extract_workers)
+
+    async def upload(file_path, source):
+        async with upload_slots:
+            await db.run(supabase_client.storage.from_("ragfiles").upload, file_path, source, timeout=rag_storage_timeout)
+
+    uploads = {i: asyncio.ensure_future(upload(paths[i], documents[i][1])) for i in changed}
+    previous_ids = [v["id"] for i in changed for v in versions.get(documents[i][0], [])]
+    extracted, known_embeddings = await asyncio.gather(
+        asyncio.gather(*(document_extractor.extract(*documents[i]) for i in changed), return_exceptions=True),
+        vector_store.chunk_embeddings(previous_ids),
+        return_exceptions=True
+    )
+    if isinstance(known_embeddings, BaseException):
+        logger.error(f"Loading previous chunk embeddings failed, embedding everything: {known_embeddings}")
+        known_embeddings = {}
+    texts = dict(zip(changed, extracted))
+    pending = []
+    for i in changed:
+        filename, text = documents[i][0], texts[i]
+        if isinstance(text, UnicodeDecodeError):
+            results[i] = {"filename": filename, "status": "invalid", "error": f"Invalid file encoding: {str(text)}"}
+        elif isinstance(text, BrokenProcessPool):
+            results[i] = {"filename": filename, "status": "failed", "error": f"Failed to extract {filename}: worker crashed"}
+        elif isinstance(text, BaseException):
+            results[i] = {"filename": filename, "status": "invalid", "error": f"Could not read {filename}: {str(text)}"}
+        elif not text[1]:  # no chunks: the text is empty or all whitespace
+            results[i] = {"filename": filename, "status": "invalid", "error": "No text could be extracted from the file"}
+        else:
+            pending.append(i)
+
+    try:
+        stored = await vector_store.add_many([{
+            "file_path": paths[i],
+            "content": texts[i][0],
+            "chunks": texts[i][1],
+            "content_hash": hashes[i],
+            "metadata": {"filename": documents[i][0], "upload_date": upload_date, "type": "rag", "agent_id": agent_id}
+        } for i in pending], user_id, known_embeddings=known_embeddings)
+    except Exception as e:
+        logger.error(f"Storing {len(pending)} RAG files failed: {e}")
+        stored = [{"error": str(e)}] * len(pending)
+    uploaded = dict(zip(changed, await asyncio.gather(*uploads.values(), return_exceptions=True)))
+
+    rolled_back = []
+    for i, outcome in zip(pending, stored):
+        filename = documents[i][0]
+        if isinstance(uploaded[i], BaseException):
+            logger.error(f"Upload failed for {filename}: {uploaded[i]}")
+            results[i] = {"filename": filename, "status": "failed", "error": f"Failed to upload {filename}: {str(uploaded[i])}"}
+            if "error" not in outcome:
+                rolled_back.append({"id": outcome["rag_id"], "file_path": paths[i]})
+        elif "error" in outcome:
+            results[i] = {"filename": filename, "status": "failed", "error": outcome["error"]}
+        else:
+            results[i] = {"filename": filename, "status": "stored", "memory_id": outcome["rag_id"],
+                          "chunks": outcome["chunks"], "embedded": outcome["embedded"]}
+    # The new version is in: its predecessors go, along with rows whose original never made it to Storage
+    retired = [v for i in changed if results[i]["status"] == "stored" for v in versions.get(documents[i][0], [])]
+    if retired or rolled_back:
+        try:
+            await db.execute(supabase_client.table("rag_metadata").delete().in_("id", [r["id"] for r in retired + rolled_back]))
+            for r in retired + rolled_back:
+                vector_store.forget_file(r["file_path"], user_id, agent_id)
+            logger.info(f"Retired {len(retired)} superseded RAG files for agent_id {agent_id}")
+        except Exception as e:
+            # Their rows still point at the objects, so leave those in place too
+            logger.error(f"Retiring {len(retired) + len(rolled_back)} superseded RAG files failed: {e}")
+            retired = []
+    # Failed uploads are included: one that timed out may still have landed in Storage
+    orphaned = [paths[i] for i in changed if results[i]["status"] != "stored"]
+    if retired or orphaned:
+        await remove_rag_objects([r["file_path"] for r in retired] + orphaned)
+    if any(r["status"] == "stored" for r in results):
+        answer_cache.invalidate(agent_id)
+    return results
+
 @app.post("/upload_rag")
 async def upload_rag(user_id: str = Form(...), agent_id: str = Form(...), file: UploadFile = File(...)):
-    vector_store = SupabaseVectorStore(supabase_client)
+    get_vector_store()
     try:
-        content = await file.read()
-        if len(content) > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File exceeds 10MB limit")
-        
-        file_path = f"{user_id}/{agent_id}/{datetime.now().isoformat()}_{file.filename}"
-        supabase_client.storage.from_("ragfiles").upload(file_path, content)
-        
-        content_str = content.decode("utf-8") if not file.filename.endswith(".pdf") else \
-                      "".join(PyPDF2.PdfReader(io.BytesIO(content)).pages[i].extract_text() 
-                              for i in range(len(PyPDF2.PdfReader(io.BytesIO(content)).pages)))
-        
-        metadata = {
-            "filename": file.filename,
-            "upload_date": datetime.now().isoformat(),
-            "type": "rag",
-            "agent_id": agent_id
-        }
-        memory_id = await vector_store.add(content_str, user_id, metadata, file_path)
-        logger.info(f"Uploaded {file.filename} to Storage at {file_path} for agent_id {agent_id}")
-        return {"message": f"Uploaded {file.filename} successfully", "memory_id": memory_id}
-    except UnicodeDecodeError as e:
-        logger.error(f"Decode error for {file.filename}: {e}")
-        raise HTTPException(status_code=400, detail=f"Invalid file encoding: {str(e)}")
+        spool = await spool_upload(file, rag_max_file_bytes, rag_upload_spool_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        result = (await ingest_documents(user_id, agent_id, [(file.filename, spool.source)]))[0]
     except Exception as e:
         logger.error(f"Upload failed for {file.filename}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to upload {file.filename}: {str(e)}")
+    finally:
+        spool.close()
+    if result["status"] == "invalid":
+        logger.error(f"Rejected {file.filename}: {result['error']}")
+        raise HTTPException(status_code=400, detail=result["error"])
+    if result["status"] == "failed":
+        raise HTTPException(status_code=500, detail=result["error"])
+    if result["status"] == "unchanged":
+        logger.info(f"{file.filename} is unchanged for agent_id {agent_id}; skipped")
+        return {"message": f"{file.filename} is unchanged", "memory_id": result["memory_id"]}
+    logger.info(f"Uploaded {file.filename} to Storage for agent_id {agent_id}")
+    return {"message": f"Uploaded {file.filename} successfully", "memory_id": result["memory_id"]}
+
+@app.post("/upload_rag_bulk")
+async def upload_rag_bulk(user_id: str = Form(...), agent_id: str = Form(...), files: List[UploadFile] = File(...)):
+    """Ingest several .txt/.pdf files and zip/tar archives of them in one go, with a result per document.
+
+    Uploads are spooled rather than held in memory, archives unpacked off
+    the event loop, and everything goes through ingest_documents together.
+    A document that can't be used is reported in its result and doesn't
+    stop the rest.
+    """
+    get_vector_store()
+    loop = asyncio.get_event_loop()
+    remaining = rag_bulk_max_mb * 1024 * 1024
+    results = []
+    documents = []  # (filename, bytes or path)
+    spools = []
+    try:
+        for file in files:
+            archive = is_archive(file.filename)
+            if not archive and not is_supported(file.filename):
+                results.append({"filename": file.filename, "status": "skipped", "error": "Unsupported file type"})
+                continue
+            try:
+                spool = await spool_upload(file, remaining if archive else rag_max_file_bytes, rag_upload_spool_bytes)
+            except ValueError as e:
+                error = "Upload exceeds the total size limit" if archive else str(e)
+                results.append({"filename": file.filename, "status": "invalid", "error": error})
+                continue
+            spools.append(spool)
+            if archive:
+                try:
+                    members, skipped = await loop.run_in_executor(None, expand_archive, file.filename, spool.source, rag_max_file_bytes, remaining)
+                except Exception as e:
+                    logger.error(f"Could not unpack {file.filename}: {e}")
+                    results.append({"filename": file.filename, "status": "invalid", "error": f"Could not unpack archive: {str(e)}"})
+                    continue
+                finally:
+                    spool.close()
+                remaining -= sum(len(data) for _, data in members)
+                documents.extend(members)
+                results.extend({"filename": name, "status": "skipped", "error": reason} for name, reason in skipped)
+            elif spool.size > remaining:
+                results.append({"filename": file.filename, "status": "invalid", "error": "Upload exceeds the total size limit"})
+            else:
+                remaining -= spool.size
+                documents.append((file.filename, spool.source))
+        if len(documents) > rag_bulk_max_files:
+            raise HTTPException(status_code=400, detail=f"Too many files: {len(documents)} (limit {rag_bulk_max_files})")
+        stored = await ingest_documents(user_id, agent_id, documents)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Bulk upload failed for agent_id {agent_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to upload files: {str(e)}")
+    finally:
+        for spool in spools:
+            spool.close()
+    results.extend(stored)
+    count = sum(1 for r in stored if r["status"] == "stored")
+    unchanged = sum(1 for r in stored if r["status"] == "unchanged")
+    logger.info(f"Bulk upload stored {count} of {len(results)} files ({unchanged} unchanged) for agent_id {agent_id}")
+    return {"message": f"Uploaded {count} of {len(results)} files ({unchanged} unchanged)", "results": results}
 
 @app.post("/upload_avatar")
 async def upload_avatar(user_id: str = Form(...), agent_id: str = Form(...), file: UploadFile = File(...)):
@@ -399,10 +1413,11 @@ async def upload_avatar(user_id: str = Form(...), agent_id: str = Form(...), fil
         
         content = await file.read()
         file_name = f"{agent_id}_{datetime.now().isoformat()}_{file.filename}"
-        response = supabase_client.storage.from_("avatars").upload(file_name, content, {"content-type": file.content_type})
+        response = await db.run(supabase_client.storage.from_("avatars").upload, file_name, content, {"content-type": file.content_type})
         
         public_url = supabase_client.storage.from_("avatars").get_public_url(file_name)
-        supabase_client.table("agents").update({"avatar_url": public_url}).eq("id", agent_id).eq("user_id", user_id).execute()
+        await db.execute(supabase_client.table("agents").update({"avatar_url": public_url}).eq("id", agent_id).eq("user_id", user_id))
+        invalidate_agent_configs(user_id)
         
         logger.info(f"Uploaded avatar for agent {agent_id}")
         return {"message": "Avatar uploaded successfully", "avatar_url": public_url}
@@ -413,7 +1428,7 @@ async def upload_avatar(user_id: str = Form(...), agent_id: str = Form(...), fil
 @app.get("/list_rag")
 async def list_rag(user_id: str):
     try:
-        response = supabase_client.table("rag_metadata").select("id, file_path, metadata").eq("user_id", user_id).execute()
+        response = await db.execute(supabase_client.table("rag_metadata").select("id, file_path, metadata").eq("user_id", user_id))
         files = [{"id": r["id"], "filename": r["metadata"].get("filename"), "agent_id": r["metadata"].get("agent_id"), "upload_date": r["metadata"].get("upload_date"), "file_path": r["file_path"]} for r in response.data]
         return {"files": files}
     except Exception as e:
@@ -423,13 +1438,17 @@ async def list_rag(user_id: str):
 @app.post("/delete_rag")
 async def delete_rag(request: DeleteRagRequest):
     try:
-        response = supabase_client.table("rag_metadata").select("file_path").eq("id", request.memory_id).eq("user_id", request.user_id).execute()
+        response = await db.execute(supabase_client.table("rag_metadata").select("file_path, agent_id").eq("id", request.memory_id).eq("user_id", request.user_id))
         if not response.data:
             raise HTTPException(status_code=404, detail="RAG file not found")
         file_path = response.data[0]["file_path"]
         
-        supabase_client.storage.from_("ragfiles").remove([file_path])
-        supabase_client.table("rag_metadata").delete().eq("id", request.memory_id).eq("user_id", request.user_id).execute()
+        await db.run(supabase_client.storage.from_("ragfiles").remove, [file_path])
+        await db.execute(supabase_client.table("rag_chunks").delete().eq("rag_id", request.memory_id))
+        await db.execute(supabase_client.table("rag_metadata").delete().eq("id", request.memory_id).eq("user_id", request.user_id))
+        if shared_vector_store is not None:
+            shared_vector_store.forget_file(file_path, request.user_id, response.data[0]["agent_id"])
+        answer_cache.invalidate(response.data[0]["agent_id"])
         
         logger.info(f"Deleted RAG file {request.memory_id} from Storage at {file_path}")
         return {"message": f"Deleted RAG file {request.memory_id} successfully"}
@@ -444,7 +1463,8 @@ async def add_agent(request: dict):
         agent = AgentConfig(**request["agent"])
         data = agent.dict(exclude={"id"})
         data["user_id"] = user_id
-        response = supabase_client.table("agents").insert(data).execute()
+        response = await db.execute(supabase_client.table("agents").insert(data))
+        invalidate_agent_configs(user_id)
         logger.info(f"Added agent {agent.name} for user {user_id}")
         return {"message": f"Added {agent.name} successfully", "agent": response.data[0]}
     except Exception as e:
@@ -454,7 +1474,7 @@ async def add_agent(request: dict):
 @app.get("/list_agents")
 async def list_agents(user_id: str):
     try:
-        response = supabase_client.table("agents").select("*").eq("user_id", user_id).execute()
+        response = await db.execute(supabase_client.table("agents").select("*").eq("user_id", user_id))
         return {"agents": response.data}
     except Exception as e:
         logger.error(f"List agents failed: {e}")
@@ -466,7 +1486,9 @@ async def update_agent(request: dict):
         user_id = request["user_id"]
         agent_id = request["agent_id"]
         agent_data = request["agent"]
-        response = supabase_client.table("agents").update(agent_data).eq("id", agent_id).eq("user_id", user_id).execute()
+        response = await db.execute(supabase_client.table("agents").update(agent_data).eq("id", agent_id).eq("user_id", user_id))
+        invalidate_agent_configs(user_id)
+        answer_cache.invalidate(agent_id)
         if not response.data:
             raise HTTPException(status_code=404, detail="Agent not found")
         updated_agent = response.data[0]
@@ -481,22 +1503,34 @@ async def delete_agent(request: dict):
     try:
         user_id = request["user_id"]
         agent_id = request["agent_id"]
-        response = supabase_client.table("agents").delete().eq("id", agent_id).eq("user_id", user_id).execute()
+        response = await db.execute(supabase_client.table("agents").delete().eq("id", agent_id).eq("user_id", user_id))
+        invalidate_agent_configs(user_id)
+        answer_cache.invalidate(agent_id)
         logger.info(f"Deleted agent {agent_id}")
         return {"message": f"Deleted agent {agent_id} successfully"}
     except Exception as e:
         logger.error(f"Delete agent failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/chat_widget")
-async def chat_widget(request: WidgetRequest):
-    vector_store = SupabaseVectorStore(supabase_client)
-    normalized_message = request.message.lower().strip()
-    
+# Widget agent configs keyed by (user_id, department); agent edits invalidate a user's entries
+agent_configs = LRUCache(agent_cache_size, ttl=agent_cache_ttl)
+
+def invalidate_agent_configs(user_id):
+    for key in agent_configs.keys():
+        if key[0] == user_id:
+            agent_configs.pop(key)
+
+# Widget answers reused across visitors asking the same thing; dropped whenever an agent's RAG files or config change
+answer_cache = SemanticAnswerCache(answer_cache_threshold, answer_cache_ttl, answer_cache_size)
+
+async def resolve_widget_agent(user_id, department):
+    agent = agent_configs.get((user_id, department))
+    if agent is not None:
+        return agent
     # Find agent by department (no default agent logic)
-    agent_response = supabase_client.table("agents").select("*").eq("user_id", request.user_id).eq("department", request.department).execute()
+    agent_response = await db.execute(supabase_client.table("agents").select("*").eq("user_id", user_id).eq("department", department))
     if not agent_response.data:
-        raise HTTPException(status_code=404, detail=f"No agent found for department: {request.department}")
+        raise HTTPException(status_code=404, detail=f"No agent found for department: {department}")
     agent_raw = agent_response.data[0]  # Take first match
     
     agent = {
@@ -515,46 +1549,80 @@ async def chat_widget(request: WidgetRequest):
         "helpdesk_subdomain": agent_raw.get("helpdesk_subdomain", ""),
         "create_tickets": agent_raw.get("create_tickets", False),
         "info": agent_raw.get("info", ""),
-        "department": agent_raw.get("department", "")
+        "department": agent_raw.get("department", ""),
+        "answer_cache": agent_raw.get("answer_cache", False),
+        "context_token_budget": agent_raw.get("context_token_budget"),
+        "context_min_similarity": agent_raw.get("context_min_similarity"),
+        "fallbacks": agent_raw.get("fallbacks") or []
     }
+    agent_configs.set((user_id, department), agent)
+    return agent
+
+@app.post("/chat_widget")
+async def chat_widget(request: WidgetRequest):
+    vector_store = get_vector_store()
+    normalized_message = request.message.lower().strip()
+    
+    agent = await resolve_widget_agent(request.user_id, request.department)
     
     if agent["api_key"] != request.api_key:
         raise HTTPException(status_code=403, detail="Invalid API key")
     
-    rag_context = await vector_store.search(normalized_message, request.user_id, agent_id=agent["id"])
-    rag_text = "\n".join([r["content"] for r in rag_context]) if rag_context else "No relevant data found."
+    conversation_id, history, conversation_reset = await open_conversation(request.user_id, request.conversation_id, request.history)
+    rag_context, query_embedding = await vector_store.search(
+        normalized_message, request.user_id, agent_id=agent["id"], limit=context_candidates, return_embedding=True
+    )
+    rag_text, context_report = build_rag_context(rag_context, agent["llm_type"], agent["context_token_budget"], agent["context_min_similarity"])
     
-    prompt = f"""
-    You’re {agent['name']} at {agent['company']}, in the {agent['department']} department. Your persona: {agent['info']}.
-    - Do NOT prepend your name, 'assistant:', 'agent:', or any role-based prefix to your response; provide only the raw message content with no labels.
-    - If the user asks "What is your name?" "Who are you?" or similar, respond naturally (e.g., "I’m {agent['name']}! How can I help you today?").
-    - Start by responding in {request.language}.
-    - If the user says "Switch to [language]" or similar (e.g., "Use Spanish"), detect the requested language (even with typos), switch to it for all future responses, and confirm: "Switched to [language]!"
-    - If the conversation history is empty (length 0), it’s the first message—end with: "By the way, need a different language? Just say 'Switch to Spanish,' 'Switch to French,' etc."—otherwise, do not include this unless the user mentions languages.
-    - Respond to casual greetings creatively and variably only if the input is clearly a greeting and not a question:
-      - "Hello" or "Hi": "Hi there! What’s on your mind today?"
-      - "Hey" or "Heya": "Heya! Good to chat—what can I do for you?"
-      - "How’s it going": "Hey, doing great—how about you? What’s up?"
-    - For any input resembling a question (e.g., starts with 'what', 'how', 'why', or contains '?'), answer directly without a greeting unless it’s the first message.
-    - For anything about {agent['company']}:
-      1. Use this data ONLY: {rag_text}. Quote it exactly—no paraphrasing, no guessing.
-      2. Guess their setup or pain points based on prior messages if available.
-      3. Give the fix or info naturally, like you’re recalling it.
-      4. If the data mentions packages, upsell once—explain the perk, ask if they’re interested, then drop it unless they bring it up again.
-    - If no data: Say: “Sorry, I don’t have specific info on that. Check {agent['company']}’s site or let me know how else I can help!”
-    - Off-topic? Say: “I’m here to assist with any {agent['company']}-related questions or support needs. How can I help you today?”—keep it simple unless it’s the first message.
-    - Be friendly, helpful, and on-brand—never bash {agent['company']}.
-    - Use the conversation history to stay consistent, vary responses, and avoid repetition unless necessary.
-    """
-    messages = [{"role": "system", "content": prompt}] + request.history + [{"role": "user", "content": request.message}]
-    raw_response = await call_llm(agent["llm_type"], agent["api_key"], messages)
+    def build_result(formatted):
+        return {
+            "agent": agent["name"],
+            "response": formatted,
+            "avatar_url": agent["avatar_url"],
+            "agent_id": agent["id"],
+            "ticket_id": None,
+            "conversation_id": conversation_id,
+            "conversation_reset": conversation_reset,
+            "context": context_report
+        }
+    
+    cache_key = None
+    if agent["answer_cache"] and query_embedding is not None and len(history) <= answer_cache_max_history:
+        context_hash = hashlib.sha256(rag_text.encode("utf-8")).hexdigest()
+        cache_key = (agent["id"], query_embedding, request.language, context_hash, not history)
+        cached_response = answer_cache.lookup(*cache_key)
+        if cached_response is not None:
+            formatted_response = f"{agent['name']}: {cached_response}"
+            logger.info(f"Answer cache hit for agent {agent['id']}")
+            await record_turns(conversation_id, request.message, formatted_response)
+            if request.stream:
+                async def cached_events():
+                    yield sse_event({"token": cached_response}, "token")
+                    yield sse_event(build_result(formatted_response), "done")
+                return StreamingResponse(cached_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+            return build_result(formatted_response)
+    
+    async def finish(sanitized):
+        if cache_key is not None:
+            answer_cache.store(*cache_key, sanitized)
+        await record_turns(conversation_id, request.message, f"{agent['name']}: {sanitized}")
+    
+    prompt = agent_prefix(agent["name"], agent["company"], agent["department"], agent["info"])
+    messages = await history_manager.build_messages(
+        agent["llm_type"], agent["api_key"], prompt, history, request.message,
+        conversation_key=conversation_id, context=session_details(request.language, rag_text)
+    )
+    if request.stream:
+        route = agent_route(agent["llm_type"], agent["api_key"], agent["fallbacks"])
+        return stream_agent_response(route, messages, agent["name"], build_result, finish)
+    raw_response = await llm_router.complete(agent_route(agent["llm_type"], agent["api_key"], agent["fallbacks"]), messages)
     
-    sanitized_response = re.sub(
-        r"^(assistant|agent|\w+):(\s+)?", "", raw_response.strip(), flags=re.IGNORECASE
-    ).strip()
+    sanitized_response = NAME_PREFIX.sub("", raw_response.strip()).strip()
     
     if not sanitized_response:
         sanitized_response = "Sorry, I didn’t catch that. How can I assist you?"
+    else:
+        await finish(sanitized_response)
     
     formatted_response = f"{agent['name']}: {sanitized_response}"
     
@@ -562,116 +1630,170 @@ async def chat_widget(request: WidgetRequest):
     logger.info(f"Sanitized response: {sanitized_response}")
     logger.info(f"Formatted response: {formatted_response}")
     
-    return {
-        "agent": agent["name"],
-        "response": formatted_response,
-        "avatar_url": agent["avatar_url"],
-        "agent_id": agent["id"],
-        "ticket_id": None
-    }
+    return build_result(formatted_response)
 
-@app.post("/create_ticket")
-async def create_ticket(request: TicketRequest):
-    try:
-        # Fetch agent by agent_id directly, no default fallback
-        agent_response = supabase_client.table("agents").select(
-            "helpdesk_client_id, helpdesk_client_secret, helpdesk_refresh_token, helpdesk_org_id, helpdesk_department_id, helpdesk_subdomain, name, helpdesk_platform"
-        ).eq("id", request.agent_id).eq("user_id", request.user_id).execute()
-        if not agent_response.data:
-            raise HTTPException(status_code=404, detail="Agent not found")
+async def submit_ticket(job_payload: dict):
+    """Create the helpdesk ticket for a queued job; run by the ticket queue workers."""
+    request = TicketRequest(**job_payload)
+    # Fetch agent by agent_id directly, no default fallback
+    agent_response = await db.execute(supabase_client.table("agents").select(
+        "helpdesk_client_id, helpdesk_client_secret, helpdesk_refresh_token, helpdesk_org_id, helpdesk_department_id, helpdesk_subdomain, name, helpdesk_platform"
+    ).eq("id", request.agent_id).eq("user_id", request.user_id))
+    if not agent_response.data:
+        raise HTTPException(status_code=404, detail="Agent not found")
         
-        agent_data = agent_response.data[0]
-        client_id = agent_data.get("helpdesk_client_id")
-        client_secret = agent_data.get("helpdesk_client_secret")
-        refresh_token = agent_data.get("helpdesk_refresh_token")
-        org_id = agent_data.get("helpdesk_org_id")
-        department_id = agent_data.get("helpdesk_department_id")
-        subdomain = agent_data.get("helpdesk_subdomain")
-        agent_name = agent_data.get("name")
-        helpdesk_platform = agent_data.get("helpdesk_platform", "")
-
-        customer_email = request.customer_email or "anonymous@example.com"
-        customer_name = request.customer_name or "Anonymous"
-        logger.info(f"Creating ticket for email: {customer_email}, name: {customer_name}, agent: {agent_name}")
-
-        subject = f"Assisted by {request.agent_name or agent_name}" if (request.agent_name or agent_name) else request.message[:50] + "..."
-
-        conversation_lines = request.response.split("\n")
-        formatted_conversation = []
-        last_speaker = None
-        for line in conversation_lines:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith("User:"):
-                cleaned_line = line.replace("User:", "").strip()
-                formatted_conversation.append(f"{customer_name}: {cleaned_line}")
-                last_speaker = customer_name
-            elif line.startswith("Agent:") or line.startswith("Assistant:") or line.startswith(f"{agent_name}:"):
-                cleaned_line = line.replace("Agent:", "").replace("Assistant:", "").replace(f"{agent_name}:", "").strip()
-                if last_speaker != agent_name:
-                    formatted_conversation.append(f"{agent_name}: {cleaned_line}")
-                else:
-                    formatted_conversation.append(cleaned_line)
-                last_speaker = agent_name
+    agent_data = agent_response.data[0]
+    client_id = agent_data.get("helpdesk_client_id")
+    client_secret = agent_data.get("helpdesk_client_secret")
+    refresh_token = agent_data.get("helpdesk_refresh_token")
+    org_id = agent_data.get("helpdesk_org_id")
+    department_id = agent_data.get("helpdesk_department_id")
+    subdomain = agent_data.get("helpdesk_subdomain")
+    agent_name = agent_data.get("name")
+    helpdesk_platform = agent_data.get("helpdesk_platform", "")
+
+    customer_email = request.customer_email or "anonymous@example.com"
+    customer_name = request.customer_name or "Anonymous"
+    logger.info(f"Creating ticket for email: {customer_email}, name: {customer_name}, agent: {agent_name}")
+
+    subject = f"Assisted by {request.agent_name or agent_name}" if (request.agent_name or agent_name) else request.message[:50] + "..."
+
+    conversation_lines = request.response.split("\n")
+    formatted_conversation = []
+    last_speaker = None
+    for line in conversation_lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("User:"):
+            cleaned_line = line.replace("User:", "").strip()
+            formatted_conversation.append(f"{customer_name}: {cleaned_line}")
+            last_speaker = customer_name
+        elif line.startswith("Agent:") or line.startswith("Assistant:") or line.startswith(f"{agent_name}:"):
+            cleaned_line = line.replace("Agent:", "").replace("Assistant:", "").replace(f"{agent_name}:", "").strip()
+            if last_speaker != agent_name:
+                formatted_conversation.append(f"{agent_name}: {cleaned_line}")
             else:
-                formatted_conversation.append(line)
-                last_speaker = None
+                formatted_conversation.append(cleaned_line)
+            last_speaker = agent_name
+        else:
+            formatted_conversation.append(line)
+            last_speaker = None
 
-        description = "\n".join(formatted_conversation) or f"User: {request.message}\nAgent: {request.response}"
-        logger.info(f"Formatted ticket description:\n{description}")
+    description = "\n".join(formatted_conversation) or f"User: {request.message}\nAgent: {request.response}"
+    logger.info(f"Formatted ticket description:\n{description}")
 
-        if request.platform.lower() == "zoho desk":
-            if not all([client_id, client_secret, refresh_token, org_id]):
-                raise HTTPException(status_code=400, detail="Zoho Desk requires Client ID, Client Secret, Refresh Token, and Org ID.")
+    if request.platform.lower() == "zoho desk":
+        if not all([client_id, client_secret, refresh_token, org_id]):
+            raise HTTPException(status_code=400, detail="Zoho Desk requires Client ID, Client Secret, Refresh Token, and Org ID.")
             
-            access_token = await get_zoho_access_token(client_id, client_secret, refresh_token)
-            contact_id = await create_zoho_contact(access_token, org_id, customer_email, customer_name)
+        contact_id = await with_zoho_token(
+            client_id, client_secret, refresh_token,
+            lambda access_token: resolve_zoho_contact(access_token, org_id, customer_email, customer_name)
+        )
             
-            url = "https://desk.zoho.in/api/v1/tickets"
-            headers = {
-                "Authorization": f"Zoho-oauthtoken {access_token}",
-                "Content-Type": "application/json",
-                "orgId": org_id
-            }
-            payload = {
+        url = "https://desk.zoho.in/api/v1/tickets"
+        # Authorization is added per attempt in send(), so a rejected token can be swapped for a fresh one
+        headers = {
+            "Content-Type": "application/json",
+            "orgId": org_id
+        }
+        payload = {
+            "subject": subject,
+            "description": description,
+            "contactId": contact_id,
+            "departmentId": department_id if department_id else request.department_id,
+            "status": "Open",
+            "priority": "Medium"
+        }
+    elif request.platform.lower() == "zendesk":
+        if not subdomain:
+            raise HTTPException(status_code=400, detail="Zendesk subdomain required for this agent.")
+        api_key = client_id
+        if not api_key:
+            raise HTTPException(status_code=400, detail="Zendesk API key required.")
+        url = f"https://{subdomain}.zendesk.com/api/v2/tickets"
+        headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        payload = {
+            "ticket": {
                 "subject": subject,
-                "description": description,
-                "contactId": contact_id,
-                "departmentId": department_id if department_id else request.department_id,
-                "status": "Open",
-                "priority": "Medium"
+                "comment": {"body": description},
+                "requester": {"name": customer_name, "email": customer_email},
+                "department_id": department_id if department_id else request.department_id
             }
-        elif request.platform.lower() == "zendesk":
-            if not subdomain:
-                raise HTTPException(status_code=400, detail="Zendesk subdomain required for this agent.")
-            api_key = client_id
-            if not api_key:
-                raise HTTPException(status_code=400, detail="Zendesk API key required.")
-            url = f"https://{subdomain}.zendesk.com/api/v2/tickets"
-            headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-            payload = {
-                "ticket": {
-                    "subject": subject,
-                    "comment": {"body": description},
-                    "requester": {"name": customer_name, "email": customer_email},
-                    "department_id": department_id if department_id else request.department_id
-                }
-            }
-        else:
-            raise HTTPException(status_code=400, detail=f"Unsupported platform: {request.platform}")
+        }
+    else:
+        raise HTTPException(status_code=400, detail=f"Unsupported platform: {request.platform}")
 
+    async def send(headers):
         logger.info(f"Sending ticket to {request.platform}: URL={url}, Headers={headers}, Payload={payload}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload) as resp:
-                if resp.status not in [200, 201]:
-                    error_text = await resp.text()
-                    logger.error(f"Ticket API response: status={resp.status}, error={error_text}")
-                    raise HTTPException(status_code=resp.status, detail=f"Ticket creation failed: {error_text}")
-                ticket = await resp.json()
-                ticket_id = ticket.get("ticketNumber") if request.platform.lower() == "zoho desk" else ticket.get("id")
-                logger.info(f"Ticket created successfully: {ticket}")
-                return {"message": f"Ticket created: {ticket_id}", "ticket_id": ticket_id}
+        async with http_client.session.post(url, headers=headers, json=payload) as resp:
+            if resp.status not in [200, 201]:
+                error_text = await resp.text()
+                logger.error(f"Ticket API response: status={resp.status}, error={error_text}")
+                if 400 <= resp.status < 500 and resp.status not in (401, 429) and request.platform.lower() == "zoho desk":
+                    # The cached contact may have been deleted or merged; look it up again next time
+                    forget_zoho_contact(org_id, customer_email)
+                retry_after = resp.headers.get("Retry-After")
+                raise HTTPException(
+                    status_code=resp.status, detail=f"Ticket creation failed: {error_text}",
+                    headers={"Retry-After": retry_after} if retry_after else None
+                )
+            ticket = await resp.json()
+            ticket_id = ticket.get("ticketNumber") if request.platform.lower() == "zoho desk" else ticket.get("id")
+            logger.info(f"Ticket created successfully: {ticket}")
+            return {"message": f"Ticket created: {ticket_id}", "ticket_id": ticket_id}
+
+    if request.platform.lower() == "zoho desk":
+        return await with_zoho_token(
+            client_id, client_secret, refresh_token,
+            lambda access_token: send({**headers, "Authorization": f"Zoho-oauthtoken {access_token}"})
+        )
+    return await send(headers)
+
+ticket_queue = TicketQueue(
+    db, supabase_client, submit_ticket,
+    workers=ticket_workers, platform_concurrency=ticket_platform_concurrency, max_attempts=ticket_max_attempts,
+    lease_timeout=ticket_lease_timeout
+)
+
+@app.on_event("startup")
+async def start_ticket_queue():
+    await ticket_queue.start()
+
+@app.on_event("shutdown")
+async def stop_ticket_queue():
+    await ticket_queue.stop()
+
+@app.post("/create_ticket")
+async def create_ticket(request: TicketRequest):
+    if request.platform.lower() not in ("zoho desk", "zendesk"):
+        raise HTTPException(status_code=400, detail=f"Unsupported platform: {request.platform}")
+    if request.conversation_id:
+        # Prefer the stored session's transcript; the job keeps its own copy in case the session expires
+        conversation = await sessions.get(request.conversation_id)
+        if conversation is not None and conversation["user_id"] == request.user_id:
+            request.response = conversation_transcript(conversation["turns"])
+            request.message = request.message or next((t["content"] for t in conversation["turns"] if t["role"] == "user"), "Chat Session")
+        elif request.response:
+            logger.warning(f"Conversation {request.conversation_id} not found; using the transcript the client sent")
+        else:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+    try:
+        job_id = await ticket_queue.enqueue(request.platform.lower(), request.dict())
+        logger.info(f"Queued ticket job {job_id} for agent {request.agent_id} on {request.platform}")
+        return {"message": f"Ticket queued: {job_id}", "job_id": job_id, "status": "queued"}
     except Exception as e:
         logger.error(f"Ticket creation failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to create ticket: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to create ticket: {str(e)}")
+
+@app.get("/ticket_status/{job_id}")
+async def ticket_status(job_id: str):
+    try:
+        job = await ticket_queue.status(job_id)
+    except Exception as e:
+        logger.error(f"Ticket status lookup failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to fetch ticket status: {str(e)}")
+    if not job:
+        raise HTTPException(status_code=404, detail="Ticket job not found")
+    return job
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Bounded least-recently-used cache with optional expiry.
+
+    Entries are evicted oldest-first once the combined size exceeds max_size.
+    sizeof measures an entry's value; by default every entry counts as 1 so
+    max_size is an entry count. With ttl set (seconds), entries older than
+    that are treated as missing. Not thread-safe: use from the event loop.
+    """
+
+    def __init__(self, max_size, sizeof=None, ttl=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or (entry[2] is not None and entry[2] < time.monotonic()):
+            if entry is not None:
+                self.pop(key)
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value):
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (value, size, expires_at)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def keys(self):
+        return list(self._entries)
+
+    def stats(self):
+        return {"entries": len(self._entries), "size": self.size, "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RefreshingTokenCache:
+    """Cache of expiring access tokens (e.g. OAuth) keyed by credentials.
+
+    fetch(*key) must return (token, expires_in_seconds). A token is refreshed
+    in the background refresh_margin seconds before it expires, as long as it
+    was used since the last refresh; unused tokens are simply dropped. Concurrent
+    callers needing a refresh for the same key share a single fetch.
+    """
+
+    def __init__(self, fetch, refresh_margin=300):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.refreshes = 0
+        self._tokens = {}  # key -> [token, expires_at, used_since_refresh]
+        self._inflight = {}
+        self._scheduled = set()
+
+    async def get(self, key):
+        entry = self._tokens.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            entry[2] = True
+            self.hits += 1
+            return entry[0]
+        return await self._refresh(key, used=True)
+
+    def invalidate(self, key, token=None):
+        """Drop key's cached token; given token, only if it's still the cached one (not already refreshed)."""
+        entry = self._tokens.get(key)
+        if entry is not None and (token is None or entry[0] == token):
+            self._tokens.pop(key, None)
+
+    async def _refresh(self, key, used):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, used))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one caller being cancelled doesn't abort the refresh others are waiting on
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, used):
+        token, expires_in = await self.fetch(*key)
+        self.refreshes += 1
+        expires_at = time.monotonic() + expires_in
+        self._tokens[key] = [token, expires_at, used]
+        refresh_task = asyncio.create_task(self._refresh_before_expiry(key, expires_at, expires_in))
+        self._scheduled.add(refresh_task)
+        refresh_task.add_done_callback(self._scheduled.discard)
+        return token
+
+    async def _refresh_before_expiry(self, key, expires_at, expires_in):
+        await asyncio.sleep(max(expires_in - self.refresh_margin, 0))
+        entry = self._tokens.get(key)
+        if entry is None or entry[1] != expires_at:
+            return  # already refreshed or invalidated in the meantime
+        if not entry[2]:
+            self._tokens.pop(key, None)
+            return
+        try:
+            await self._refresh(key, used=False)
+        except Exception as e:
+            # The current token is still valid until expiry; the next caller after that retries
+            logger.error(f"Background token refresh failed: {e}")
+
+    async def close(self):
+        for task in list(self._scheduled):
+            task.cancel()
+        self._scheduled.clear()
+
+    def stats(self):
+        return {"tokens": len(self._tokens), "hits": self.hits, "refreshes": self.refreshes}
@@ -0,0 +1,88 @@
+import hashlib
+
+from .history import count_tokens
+
+# Characters compared when trimming text a passage shares with an overlapping neighbour
+OVERLAP_PROBE = 40
+# Trimmed passages shorter than this add nothing useful and are dropped
+MIN_PASSAGE_CHARS = 40
+
+
+def _fingerprint(text):
+    return hashlib.sha256(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+
+
+def _trim_overlap(content, start, end, selected):
+    """Cut text content shares with already-selected passages of the same file, or return None if nothing new is left.
+
+    Offsets decide which side overlaps; the cut itself is found in the text,
+    because chunk contents are whitespace-stripped and don't map 1:1 onto offsets.
+    """
+    for other in selected:
+        if other["start"] >= end or start >= other["end"]:
+            continue
+        if other["start"] <= start and end <= other["end"]:
+            return None
+        if other["start"] <= start:
+            probe = other["content"][-OVERLAP_PROBE:]
+            cut = content.find(probe)
+            if cut != -1:
+                content = content[cut + len(probe):].strip()
+        elif end <= other["end"]:
+            probe = other["content"][:OVERLAP_PROBE]
+            cut = content.find(probe)
+            if cut != -1:
+                content = content[:cut].strip()
+    return content if len(content) >= MIN_PASSAGE_CHARS else None
+
+
+def assemble_context(results, llm_type, token_budget, min_similarity=None, separator="\n"):
+    """Build the retrieved-context text for a prompt from ranked search results.
+
+    Hits below min_similarity are dropped, then exact duplicates and text
+    overlapping a higher-ranked passage from the same file. What's left fills
+    token_budget (counted for llm_type) in rank order; passages that don't fit
+    are skipped, except that an oversized top passage is truncated rather than
+    leaving the context empty. Returns the text plus counts for reporting.
+    """
+    report = {"candidates": len(results), "below_cutoff": 0, "duplicates": 0, "over_budget": 0}
+    seen = set()
+    by_file = {}
+    passages = []
+    tokens = 0
+    separator_tokens = count_tokens(llm_type, separator)
+    for result in results:
+        metadata = result.get("metadata") or {}
+        similarity = metadata.get("similarity")
+        if min_similarity is not None and similarity is not None and similarity < min_similarity:
+            report["below_cutoff"] += 1
+            continue
+        content = result["content"].strip()
+        fingerprint = _fingerprint(content)
+        if fingerprint in seen:
+            report["duplicates"] += 1
+            continue
+        file_path, start, end = metadata.get("file_path"), metadata.get("start_offset"), metadata.get("end_offset")
+        if file_path is not None and start is not None and end is not None:
+            content = _trim_overlap(content, start, end, by_file.get(file_path, []))
+            if content is None:
+                report["duplicates"] += 1
+                continue
+        cost = count_tokens(llm_type, content) + (separator_tokens if passages else 0)
+        if tokens + cost > token_budget:
+            if passages:
+                report["over_budget"] += 1
+                continue
+            # Keep the best hit even if it alone exceeds the budget, cut down to roughly fit
+            content = content[:max(len(content) * token_budget // cost, 0)]
+            cost = count_tokens(llm_type, content)
+            if not content:
+                report["over_budget"] += 1
+                continue
+        seen.add(fingerprint)
+        if file_path is not None and start is not None and end is not None:
+            by_file.setdefault(file_path, []).append({"start": start, "end": end, "content": content})
+        passages.append(content)
+        tokens += cost
+    text = separator.join(passages)
+    return text, {**report, "passages": len(passages), "tokens": tokens, "chars": len(text)}
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class SupabaseExecutor:
+    """Runs blocking supabase-py calls on a dedicated thread pool.
+
+    The sync client does a full HTTP round trip inside every .execute() and
+    storage call; running those directly in an async handler stalls the whole
+    event loop. max_workers caps how many Supabase calls are in flight at once
+    (and so how many connections the client opens); extra calls wait in the
+    pool's queue. Every call gets a timeout so a hung request can't hold a
+    handler forever. The worker thread itself can't be cancelled, so a timed
+    out call still occupies its slot until the underlying request returns.
+    """
+
+    def __init__(self, max_workers=16, timeout=10.0):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+        self.in_flight = 0
+        self.calls = 0
+        self.timeouts = 0
+
+    async def run(self, fn, *args, timeout=None):
+        loop = asyncio.get_event_loop()
+        self.in_flight += 1
+        self.calls += 1
+        start = time.time()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self.executor, lambda: fn(*args)), timeout or self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.error(f"Supabase call {getattr(fn, '__qualname__', fn)} timed out after {time.time() - start:.2f}s")
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def execute(self, query, timeout=None):
+        """Execute a PostgREST query builder (table/rpc chain) off the event loop."""
+        return await self.run(query.execute, timeout=timeout)
+
+    def stats(self):
+        return {"max_workers": self.max_workers, "in_flight": self.in_flight, "calls": self.calls, "timeouts": self.timeouts}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class BatchWriter:
+    """Write-behind buffer that bulk-inserts rows into a table in the background.
+
+    Callers add rows without waiting for the database. Rows are flushed every
+    flush_interval seconds, or sooner once batch_size rows are pending. Rows
+    sharing a key are written once. When max_pending rows are already queued
+    (e.g. the database is down) new rows are dropped rather than growing
+    memory without bound.
+    """
+
+    def __init__(self, db, client, table, batch_size=100, flush_interval=1.0, max_pending=10000):
+        self.db = db
+        self.client = client
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, key, row):
+        if key not in self.pending and len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending[key] = row
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        rows = list(self.pending.values())
+        self.pending = {}
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i:i + self.batch_size]
+            try:
+                await self.db.execute(self.client.table(self.table).insert(batch))
+                self.written += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.error(f"Failed to write {len(batch)} rows to {self.table}: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {"pending": len(self.pending), "written": self.written, "failed": self.failed, "dropped": self.dropped}
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent encode requests into batched forward passes.
+
+    Requests arriving within batch_window_ms of the first queued one (up to
+    max_batch_size) are encoded together in a single embedder.encode call on a
+    dedicated worker thread, and each caller gets its own vector back. One
+    batched pass over N texts is much cheaper than N single-item passes
+    competing for the same CPU cores.
+    """
+
+    def __init__(self, embedder, max_batch_size=32, batch_window_ms=5.0):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedder")
+        self.batches = 0
+        self.items = 0
+        self._queue = None
+        self._task = None
+
+    def _encode(self, texts, batch_size=None):
+        return [v.tolist() for v in self.embedder.encode(texts, batch_size=batch_size or self.max_batch_size)]
+
+    async def encode(self, text):
+        if self._task is None:
+            raise RuntimeError("EmbeddingBatcher.start() must be called before encode()")
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def encode_many(self, texts, batch_size=None):
+        """Encode an already-batched list (e.g. document chunks) on the same worker.
+
+        The texts go to the worker one batch_size slice at a time, so query
+        batches queued meanwhile run between slices instead of waiting for
+        the whole document.
+        """
+        loop = asyncio.get_event_loop()
+        batch_size = batch_size or self.max_batch_size
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            vectors.extend(await loop.run_in_executor(self.executor, self._encode, texts[start:start + batch_size], batch_size))
+        return vectors
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return [(text, future) for text, future in batch if not future.cancelled()]
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            try:
+                vectors = await loop.run_in_executor(self.executor, self._encode, [text for text, _ in batch])
+            except Exception as e:
+                logger.error(f"Batched encode of {len(batch)} texts failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0,
+            "queued": self._queue.qsize() if self._queue is not None else 0
+        }
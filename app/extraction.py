@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .ingest import extract_text, hashed_chunks
+
+try:
+    import resource
+except ImportError:  # optional: not on Windows, where only the pool-level time limit applies
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionLimitExceeded(Exception):
+    """A document used up its CPU or wall-clock allowance while being extracted."""
+
+
+def _raise_limit(signum, frame):
+    raise ExtractionLimitExceeded("CPU time limit exceeded" if signum == getattr(signal, "SIGXCPU", None) else "Time limit exceeded")
+
+
+def _init_worker():
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, _raise_limit)
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _raise_limit)
+
+
+def _extract_worker(filename, source, timeout, cpu_seconds, chunk_size, chunk_overlap):
+    """Runs in a pool process: extract and chunk one document under its CPU and wall-clock limits."""
+    limits = None
+    if resource is not None and cpu_seconds:
+        # RLIMIT_CPU counts the process's whole lifetime, so each document gets "used so far + its allowance"
+        limits = resource.getrlimit(resource.RLIMIT_CPU)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+        if limits[1] != resource.RLIM_INFINITY:
+            soft = min(soft, limits[1])
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, limits[1]))
+    alarm = timeout and hasattr(signal, "setitimer")
+    if alarm:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        text = extract_text(filename, source)
+        return text, hashed_chunks(text, chunk_size, chunk_overlap)
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, limits)
+
+
+class SpooledUpload:
+    """An uploaded file copied in chunks: held in memory up to memory_bytes, past that in a temp file.
+
+    source is what extraction and the Storage upload read: the bytes, or the
+    temp file's path so worker processes open it themselves instead of
+    having the whole document pickled over to them. close() removes the file.
+    """
+
+    def __init__(self, memory_bytes):
+        self.memory_bytes = memory_bytes
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is None and self.size > self.memory_bytes:
+            self.file = tempfile.NamedTemporaryFile(prefix="rag_upload_", delete=False)
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.buffer.extend(data)
+
+    @property
+    def source(self):
+        if self.file is None:
+            return bytes(self.buffer)
+        self.file.flush()
+        return self.file.name
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.unlink(self.file.name)
+            except OSError as e:
+                logger.error(f"Could not remove spooled upload {self.file.name}: {e}")
+            self.file = None
+        self.buffer = bytearray()
+
+
+async def spool_upload(upload, max_bytes, memory_bytes, chunk_size=1024 * 1024):
+    """Copy a FastAPI UploadFile into a SpooledUpload chunk by chunk; ValueError once it passes max_bytes."""
+    spool = SpooledUpload(memory_bytes)
+    try:
+        while True:
+            chunk = await upload.read(chunk_size)
+            if not chunk:
+                return spool
+            if spool.size + len(chunk) > max_bytes:
+                raise ValueError(f"File exceeds {max_bytes // (1024 * 1024)}MB limit")
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+
+
+class DocumentExtractor:
+    """Pulls text out of documents and chunks it in a pool of worker processes, off the event loop.
+
+    Each document is parsed once, in one worker, with a wall-clock limit of
+    timeout seconds and (where the resource module exists) cpu_seconds of
+    CPU; a document over either fails with ExtractionLimitExceeded and the
+    worker moves on. At most max_workers documents are extracted at once and
+    the others wait their turn, so queueing doesn't eat into the limits. If
+    a worker hangs where signals can't reach it, or dies, the pool is
+    replaced. Workers are spawned rather than forked from the threaded server.
+    """
+
+    def __init__(self, max_workers=4, timeout=60.0, cpu_seconds=30, chunk_size=1000, chunk_overlap=200):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.pool = self._new_pool()
+        self.slots = None
+        self.in_progress = 0
+        self.extracted = 0
+        self.failed = 0
+        self.limited = 0
+        self.pool_restarts = 0
+        self.busy_seconds = 0.0
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker)
+
+    def _restart_pool(self, pool):
+        if pool is not self.pool:
+            return  # another extraction already replaced it
+        self.pool_restarts += 1
+        self.pool = self._new_pool()
+        for process in list((pool._processes or {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def extract(self, filename, source):
+        """(text, chunks) of a .txt/.pdf document given its bytes or a path to it.
+
+        chunks are hashed_chunks of the text with the extractor's chunk_size and chunk_overlap.
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        async with self.slots:
+            pool = self.pool
+            loop = asyncio.get_event_loop()
+            self.in_progress += 1
+            start = time.monotonic()
+            try:
+                # A little grace over the in-worker alarm, which normally fires first
+                extracted = await asyncio.wait_for(
+                    loop.run_in_executor(pool, _extract_worker, filename, source, self.timeout, self.cpu_seconds,
+                                         self.chunk_size, self.chunk_overlap),
+                    self.timeout + 5
+                )
+            except asyncio.TimeoutError:
+                self.limited += 1
+                logger.error(f"Extraction of {filename} hung past {self.timeout}s; restarting the extraction pool")
+                self._restart_pool(pool)
+                raise ExtractionLimitExceeded("Time limit exceeded")
+            except ExtractionLimitExceeded:
+                self.limited += 1
+                raise
+            except BrokenProcessPool:
+                self.failed += 1
+                logger.error(f"Extraction worker died on {filename}; restarting the extraction pool")
+                self._restart_pool(pool)
+                raise
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.in_progress -= 1
+                self.busy_seconds += time.monotonic() - start
+            self.extracted += 1
+            return extracted
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "in_progress": self.in_progress,
+            "extracted": self.extracted,
+            "failed": self.failed,
+            "limited": self.limited,
+            "pool_restarts": self.pool_restarts,
+            "busy_seconds": round(self.busy_seconds, 3)
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import math
+
+from .caches import LRUCache
+
+try:
+    import tiktoken
+except ImportError:  # optional: token counts fall back to a per-model character estimate
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# tiktoken encodings for models whose tokenizer it ships; others are estimated
+TIKTOKEN_ENCODINGS = {"gpt": "cl100k_base", "grok": "cl100k_base"}
+# Average characters per token, used when no tokenizer is available for the model
+CHARS_PER_TOKEN = {"deepseek": 3.5, "gpt": 4.0, "grok": 4.0, "gemini": 4.0}
+# Role markers and separators each chat message adds on top of its content
+MESSAGE_OVERHEAD = 4
+
+_encoders = {}
+
+
+def _encoder(llm_type):
+    name = TIKTOKEN_ENCODINGS.get(llm_type)
+    if tiktoken is None or name is None:
+        return None
+    if name not in _encoders:
+        _encoders[name] = tiktoken.get_encoding(name)
+    return _encoders[name]
+
+
+def count_tokens(llm_type, text):
+    """Token count of text for llm_type (exact with tiktoken where supported, else estimated)."""
+    if not text:
+        return 0
+    encoder = _encoder(llm_type)
+    if encoder is not None:
+        return len(encoder.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN.get(llm_type, 4.0))
+
+
+def count_message_tokens(llm_type, messages):
+    return sum(count_tokens(llm_type, m.get("content", "")) + MESSAGE_OVERHEAD for m in messages)
+
+
+def _hash_messages(messages):
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class HistoryManager:
+    """Keeps chat prompts within a per-model token budget.
+
+    build_messages returns [system prompt, summary?, recent turns..., context?,
+    user message] where everything fits the budget for llm_type. Per-request
+    context goes after the history so the system prompt and history form a
+    stable prefix for the providers' prompt caches. Turns that don't fit are
+    folded into a rolling summary produced by
+    summarize(llm_type, api_key, previous_summary, turns) and cached per
+    conversation. When folding, history is cut down to half of what's
+    available so the following turns reuse the cached summary instead of
+    summarizing again every request; later folds only summarize the turns
+    added since the previous one.
+    """
+
+    def __init__(self, summarize, budgets=None, default_budget=6000, summary_tokens=300, cache_size=10000, cache_ttl=3600):
+        self.summarize = summarize
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.summary_tokens = summary_tokens
+        self.summaries = LRUCache(cache_size, ttl=cache_ttl)
+        self.compacted = 0
+        self.summaries_reused = 0
+        self.summaries_generated = 0
+        self.summary_failures = 0
+        self.turns_folded = 0
+
+    def budget(self, llm_type):
+        return self.budgets.get(llm_type, self.default_budget)
+
+    async def build_messages(self, llm_type, api_key, system_prompt, history, user_message, conversation_key=None, context=None):
+        system = {"role": "system", "content": system_prompt}
+        tail = ([{"role": "system", "content": context}] if context else []) + [{"role": "user", "content": user_message}]
+        available = self.budget(llm_type) - count_message_tokens(llm_type, [system] + tail)
+        turn_tokens = [count_message_tokens(llm_type, [m]) for m in history]
+        if sum(turn_tokens) <= available:
+            return [system] + history + tail
+
+        self.compacted += 1
+        available -= self.summary_tokens + MESSAGE_OVERHEAD
+        key = conversation_key or _hash_messages(history[:2])
+        cached = self.summaries.get(key)
+        if cached is not None and (cached["count"] > len(history) or cached["hash"] != _hash_messages(history[:cached["count"]])):
+            cached = None  # a different conversation, or history was edited
+
+        if cached is not None and sum(turn_tokens[cached["count"]:]) <= available:
+            split, summary = cached["count"], cached["summary"]
+            self.summaries_reused += 1
+        else:
+            split, kept = len(history), 0
+            while split > 0 and kept + turn_tokens[split - 1] <= available // 2:
+                split -= 1
+                kept += turn_tokens[split]
+            start = cached["count"] if cached is not None else 0
+            previous = cached["summary"] if cached is not None else ""
+            try:
+                summary = await self.summarize(llm_type, api_key, previous, history[start:split])
+                self.summaries_generated += 1
+                self.turns_folded += split - start
+                self.summaries.set(key, {"count": split, "hash": _hash_messages(history[:split]), "summary": summary})
+            except Exception as e:
+                # Older turns are simply dropped this time; the next request tries again
+                logger.error(f"History summarization failed: {e}")
+                self.summary_failures += 1
+                summary = previous
+
+        messages = [system]
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        return messages + history[split:] + tail
+
+    def stats(self):
+        return {
+            "compacted": self.compacted,
+            "summaries_reused": self.summaries_reused,
+            "summaries_generated": self.summaries_generated,
+            "summary_failures": self.summary_failures,
+            "turns_folded": self.turns_folded,
+            "summary_cache": self.summaries.stats()
+        }
@@ -0,0 +1,97 @@
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClientManager:
+    """App-lifetime aiohttp session shared by all outbound HTTP calls.
+
+    One pooled session keeps TCP+TLS connections to the LLM providers, Zoho
+    and Zendesk alive between requests instead of handshaking per call.
+    limit caps total open connections and limit_per_host caps them per
+    provider; requests beyond that wait for a free connection, which shows up
+    as queued/queue wait in stats() - the signal for sizing the pool.
+    """
+
+    def __init__(self, limit=100, limit_per_host=20, dns_cache_ttl=300, connect_timeout=5.0, read_timeout=60.0):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.queued_total = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self._session = None
+
+    def _trace_config(self):
+        trace = aiohttp.TraceConfig()
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.monotonic()
+            self.queued += 1
+            self.queued_total += 1
+
+        async def on_queued_end(session, ctx, params):
+            self.queued -= 1
+            waited = time.monotonic() - ctx.queued_at
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+
+        async def on_create_end(session, ctx, params):
+            self.connections_created += 1
+
+        async def on_reuse(session, ctx, params):
+            self.connections_reused += 1
+
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_end.append(on_create_end)
+        trace.on_connection_reuseconn.append(on_reuse)
+        return trace
+
+    async def start(self):
+        if self._session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=self.dns_cache_ttl
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=self.timeout, trace_configs=[self._trace_config()]
+        )
+        logger.info(f"HTTP client started (limit={self.limit}, limit_per_host={self.limit_per_host})")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            raise RuntimeError("HTTP client is not started")
+        return self._session
+
+    def stats(self):
+        connector = self._session.connector if self._session is not None else None
+        # aiohttp doesn't expose pool occupancy publicly; these are best-effort
+        in_use = len(getattr(connector, "_acquired", ())) if connector else 0
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values()) if connector else 0
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "in_use": in_use,
+            "idle": idle,
+            "saturation": round(in_use / self.limit, 3) if self.limit else 0,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "queued": self.queued,
+            "queued_total": self.queued_total,
+            "queue_wait_avg": round(self.queue_wait_total / self.queued_total, 4) if self.queued_total else 0,
+            "queue_wait_max": round(self.queue_wait_max, 4)
+        }
@@ -0,0 +1,155 @@
+import hashlib
+import io
+import tarfile
+import zipfile
+import zlib
+
+import PyPDF2
+
+
+# Preferred chunk ends are content-defined: a whitespace position qualifies when the hash of the
+# CUT_WINDOW characters before it is divisible by CUT_DIVISOR. Where chunks end then depends on the
+# nearby text rather than on where the previous chunk ended, so after an edit the chunking falls
+# back in step within a chunk or two and the rest of the document chunks exactly as before.
+CUT_WINDOW = 16
+CUT_DIVISOR = 32
+
+
+def _chunk_end(text, low, high):
+    """Chunk end in (low, high]: the last content-defined cut point, else the last whitespace, else high."""
+    fallback = None
+    for i in range(high, low, -1):
+        if text[i - 1].isspace():
+            if zlib.crc32(text[max(i - CUT_WINDOW, 0):i].encode("utf-8")) % CUT_DIVISOR == 0:
+                return i
+            if fallback is None:
+                fallback = i
+    return fallback or high
+
+
+def chunk_text(text, chunk_size=1000, overlap=200):
+    """Split text into overlapping chunks of roughly chunk_size characters.
+
+    Chunks end on whitespace where possible so words aren't cut in half,
+    preferring content-defined cut points so an edit only changes the chunks
+    around it. Each chunk keeps its character offsets into the original text
+    so search hits can point back to where they came from.
+    """
+    if overlap >= chunk_size:
+        raise ValueError("Chunk overlap must be smaller than the chunk size")
+    chunks = []
+    length = len(text)
+    start = 0
+    while start < length:
+        end = min(start + chunk_size, length)
+        if end < length:
+            end = _chunk_end(text, start + chunk_size // 2, end)
+        content = text[start:end].strip()
+        if content:
+            chunks.append({"index": len(chunks), "start": start, "end": end, "content": content})
+        if end >= length:
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hashed_chunks(text, chunk_size=1000, overlap=200):
+    """chunk_text's chunks, each with the chunk_hash of its content under "hash"."""
+    chunks = chunk_text(text, chunk_size, overlap)
+    for chunk in chunks:
+        chunk["hash"] = chunk_hash(chunk["content"])
+    return chunks
+
+
+def content_hash(source, block_size=1024 * 1024):
+    """sha256 hex digest of a document given as bytes or a file path."""
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+SUPPORTED_EXTENSIONS = (".txt", ".pdf")
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2")
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_supported(filename):
+    return filename.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def extract_text(filename, source):
+    """Text of a .txt (UTF-8) or .pdf document given as bytes or a file path.
+
+    The PDF is parsed once and its pages walked in order. Raises
+    UnicodeDecodeError or a PyPDF2 error for documents it can't read.
+    """
+    if filename.lower().endswith(".pdf"):
+        reader = PyPDF2.PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+        return "".join(page.extract_text() or "" for page in reader.pages)
+    if not isinstance(source, bytes):
+        with open(source, "rb") as f:
+            source = f.read()
+    return source.decode("utf-8")
+
+
+def _archive_members(filename, source):
+    """Yield (name, declared size, read) for each regular file in a zip or tar archive (bytes or path)."""
+    fileobj = io.BytesIO(source) if isinstance(source, bytes) else open(source, "rb")
+    try:
+        if filename.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(fileobj)
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda limit, info=info: archive.open(info).read(limit)
+        else:
+            archive = tarfile.open(fileobj=fileobj, mode="r:*")
+            for member in archive.getmembers():
+                if member.isfile():
+                    yield member.name, member.size, lambda limit, member=member: archive.extractfile(member).read(limit)
+    finally:
+        fileobj.close()
+
+def expand_archive(filename, source, max_file_bytes, max_total_bytes):
+    """Unpack the supported documents in a zip/tar archive without touching disk.
+
+    Returns (documents, skipped): documents as (member name, bytes), skipped as
+    (member name, reason). Hidden files and unsupported types are skipped, as
+    are members over max_file_bytes; unpacking stops at max_total_bytes. Sizes
+    are checked both against the archive's header and the bytes actually read,
+    so a member lying about its size can't blow past the limits.
+    """
+    documents, skipped = [], []
+    total = 0
+    for name, size, read in _archive_members(filename, source):
+        base = name.rsplit("/", 1)[-1]
+        if not base or base.startswith(".") or "__MACOSX/" in name:
+            continue
+        if not is_supported(base):
+            skipped.append((name, "Unsupported file type"))
+            continue
+        if size > max_file_bytes:
+            skipped.append((name, f"File exceeds {max_file_bytes // (1024 * 1024)}MB limit"))
+            continue
+        if total + size > max_total_bytes:
+            skipped.append((name, "Archive exceeds the total size limit"))
+            continue
+        content = read(max_file_bytes + 1)
+        if len(content) > max_file_bytes:
+            skipped.append((name, f"File exceeds {max_file_bytes // (1024 * 1024)}MB limit"))
+            continue
+        if total + len(content) > max_total_bytes:
+            skipped.append((name, "Archive exceeds the total size limit"))
+            continue
+        total += len(content)
+        documents.append((name, content))
+    return documents, skipped
@@ -0,0 +1,156 @@
+import asyncio
+import math
+import re
+from collections import Counter
+
+# Keeps codes like "ab-1234", "v2.1" or "plan_pro" as single terms
+TOKEN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+# Ignored when judging how much of a query a hit covers
+STOPWORDS = frozenset(
+    "a an and are can do does for how i in is it my of on or the to what when where which who why with you your".split()
+)
+
+
+def _stem(term):
+    """Fold simple English plurals so "refunds" matches "refund"; codes and numbers are left alone."""
+    if len(term) <= 3 or not term.isalpha():
+        return term
+    if term.endswith("ies") and len(term) > 4:
+        return term[:-3] + "y"
+    if term.endswith("s") and not term.endswith(("ss", "us", "is")):
+        return term[:-1]
+    return term
+
+
+def tokenize(text, drop_stopwords=False):
+    terms = TOKEN.findall(text.lower())
+    if drop_stopwords:
+        terms = [t for t in terms if t not in STOPWORDS]
+    return [_stem(t) for t in terms]
+
+
+def _count_terms(rows):
+    """(row without its "embedding", term counts) per row (runs off the event loop)."""
+    return [({k: v for k, v in r.items() if k != "embedding"}, Counter(tokenize(r["content"]))) for r in rows]
+
+
+class _Partition:
+    def __init__(self):
+        self.rows = {}  # doc id -> row
+        self.lengths = {}  # doc id -> number of terms
+        self.postings = {}  # term -> {doc id: term frequency}
+        self.total_length = 0
+        self.next_id = 0
+
+    def add(self, docs):
+        for row, terms in docs:
+            doc_id = self.next_id
+            self.next_id += 1
+            self.rows[doc_id] = row
+            self.lengths[doc_id] = sum(terms.values())
+            self.total_length += self.lengths[doc_id]
+            for term, tf in terms.items():
+                self.postings.setdefault(term, {})[doc_id] = tf
+
+    def remove(self, predicate):
+        doomed = [doc_id for doc_id, row in self.rows.items() if predicate(row)]
+        for doc_id in doomed:
+            row = self.rows.pop(doc_id)
+            self.total_length -= self.lengths.pop(doc_id)
+            for term in set(tokenize(row["content"])):
+                docs = self.postings.get(term)
+                if docs is not None:
+                    docs.pop(doc_id, None)
+                    if not docs:
+                        del self.postings[term]
+        return len(doomed)
+
+    def idf(self, term):
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.rows) - df + 0.5) / (df + 0.5))
+
+    def search(self, terms, limit, k1, b):
+        if not self.rows:
+            return []
+        avg_length = self.total_length / len(self.rows)
+        scores = {}
+        for term in set(terms):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = self.idf(term)
+            for doc_id, tf in docs.items():
+                norm = tf + k1 * (1 - b + b * self.lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (k1 + 1) / norm
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        # Confidence: idf-weighted share of the query's (content) words the hit contains.
+        # Words no document has count with the highest idf, so they pull confidence down.
+        max_idf = self.idf("")
+        weights = {t: self.idf(t) if t in self.postings else max_idf for t in set(terms)}
+        total_weight = sum(weights.values())
+        hits = []
+        for doc_id, score in top:
+            matched = sum(w for t, w in weights.items() if doc_id in self.postings.get(t, ()))
+            hits.append((self.rows[doc_id], score, matched / total_weight if total_weight else 0.0))
+        return hits
+
+
+class LexicalIndex:
+    """In-process BM25 inverted index over chunk text, partitioned by (user_id, agent_id).
+
+    Complements the vector search for exact lookups (order codes, SKUs, plan
+    names) that embeddings handle badly. search returns rows in the
+    match_rag_chunks shape plus "bm25" and "confidence" (0-1, how much of the
+    query's content words the hit contains). Like LocalVectorIndex it lives in
+    one process, so with several workers only the one handling an upload or
+    delete sees it until the others restart. Terms are lowercased and
+    plurals folded; stopwords are ignored in queries.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.partitions = {}
+
+    async def add(self, user_id, agent_id, rows, batch_size=500):
+        """Add chunk rows (match_rag_chunks fields); any "embedding" is dropped.
+
+        Rows are tokenized on a worker thread, then merged into the postings
+        batch_size at a time, yielding to the event loop in between.
+        """
+        if not rows:
+            return
+        docs = await asyncio.get_running_loop().run_in_executor(None, _count_terms, rows)
+        partition = self.partitions.setdefault((user_id, agent_id), _Partition())
+        for start in range(0, len(docs), batch_size):
+            partition.add(docs[start:start + batch_size])
+            await asyncio.sleep(0)
+
+    def remove_file(self, user_id, agent_id, file_path):
+        partition = self.partitions.get((user_id, agent_id))
+        if partition is None:
+            return 0
+        return partition.remove(lambda row: row["file_path"] == file_path)
+
+    def search(self, query, user_id, agent_id=None, limit=3):
+        # Stopwords alone would match nearly every chunk, so only content words are scored
+        terms = tokenize(query, drop_stopwords=True)
+        if not terms:
+            return []
+        if agent_id is not None:
+            keys = [(user_id, agent_id)] if (user_id, agent_id) in self.partitions else []
+        else:
+            keys = [key for key in self.partitions if key[0] == user_id]
+        hits = []
+        for key in keys:
+            for row, score, confidence in self.partitions[key].search(terms, limit, self.k1, self.b):
+                hits.append({**row, "bm25": score, "confidence": confidence})
+        hits.sort(key=lambda h: h["bm25"], reverse=True)
+        return hits[:limit]
+
+    def stats(self):
+        return {
+            "partitions": len(self.partitions),
+            "chunks": sum(len(p.rows) for p in self.partitions.values()),
+            "terms": sum(len(p.postings) for p in self.partitions.values())
+        }
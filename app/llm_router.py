@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker:
+    """Tracks one provider/key's recent calls and stops sending it traffic while it's unhealthy.
+
+    Closed: calls flow; it trips open once the last `window` calls (at least
+    min_calls) have an error rate >= error_rate or a p90 latency above
+    latency_threshold. Open: calls are refused for cooldown seconds. Half-open:
+    a single probe call decides whether to close again or reopen.
+    """
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5, latency_threshold=30.0, cooldown=30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency_threshold = latency_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.trips = 0
+        self._results = deque(maxlen=window)  # (ok, latency)
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def retry_after(self):
+        return max(int(self.cooldown - (time.monotonic() - self._opened_at)), 1)
+
+    def _trip(self):
+        self.state = "open"
+        self.trips += 1
+        self._opened_at = time.monotonic()
+        self._results.clear()
+
+    def record(self, ok, latency):
+        if self.state == "half_open":
+            self._probing = False
+            if ok and latency < self.latency_threshold:
+                self.state = "closed"
+            else:
+                self._trip()
+            return
+        self._results.append((ok, latency))
+        if len(self._results) < self.min_calls:
+            return
+        errors = sum(1 for ok, _ in self._results if not ok)
+        if errors / len(self._results) >= self.error_rate or _percentile([l for _, l in self._results], 0.9) > self.latency_threshold:
+            self._trip()
+
+    def release(self):
+        """Forget a half-open probe that was cancelled before it finished."""
+        if self.state == "half_open":
+            self._probing = False
+
+    def latency_percentile(self, p):
+        latencies = [l for ok, l in self._results if ok]
+        return _percentile(latencies, p) if len(latencies) >= self.min_calls else None
+
+    def stats(self):
+        calls = len(self._results)
+        return {
+            "state": self.state,
+            "trips": self.trips,
+            "recent_calls": calls,
+            "recent_error_rate": round(sum(1 for ok, _ in self._results if not ok) / calls, 3) if calls else 0,
+            "p90_latency": round(_percentile([l for _, l in self._results], 0.9), 3) if calls else None
+        }
+
+
+class LLMRouter:
+    """Routes a chat completion over an agent's provider chain.
+
+    A route is a list of (llm_type, api_key): the agent's own provider first,
+    then its declared fallbacks. Each call gets that provider's deadlines
+    ({"connect", "first_byte", "total"} seconds) and is tracked by a circuit
+    breaker per (llm_type, api_key); providers whose breaker is open are
+    skipped, and a failed call fails over to the next one. With hedging on,
+    a non-streaming call still running after the primary's hedge_percentile
+    latency (at least hedge_min_delay seconds) starts the next provider in
+    parallel and keeps whichever answers first. Streaming calls fail over
+    only until the first token: after that the answer can't be swapped.
+
+    call(llm_type, api_key, messages, deadlines) and
+    stream(llm_type, api_key, messages, deadlines) do the provider requests.
+    With an AdmissionController, each request first waits for a slot on its
+    (llm_type, api_key), and provider 429s throttle that key instead of
+    counting against the breaker.
+    """
+
+    def __init__(self, call, stream, deadlines, default_deadlines, breaker_settings=None,
+                 hedging=False, hedge_percentile=0.95, hedge_min_delay=2.0, admission=None):
+        self.call = call
+        self.stream_call = stream
+        self.admission = admission
+        self.deadlines = deadlines
+        self.default_deadlines = default_deadlines
+        self.breaker_settings = breaker_settings or {}
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.breakers = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.rejected = 0
+
+    def _breaker(self, target):
+        breaker = self.breakers.get(target)
+        if breaker is None:
+            breaker = self.breakers[target] = CircuitBreaker(**self.breaker_settings)
+        return breaker
+
+    def _deadlines(self, llm_type):
+        return self.deadlines.get(llm_type, self.default_deadlines)
+
+    async def _admit(self, target, breaker):
+        if self.admission is None:
+            return
+        try:
+            await self.admission.acquire(target)
+        except (HTTPException, asyncio.CancelledError):
+            breaker.release()
+            raise
+
+    def _release(self, target):
+        if self.admission is not None:
+            self.admission.release(target)
+
+    def _record_success(self, target, breaker, start):
+        breaker.record(True, time.monotonic() - start)
+        if self.admission is not None:
+            self.admission.record_success(target)
+
+    def _record_failure(self, target, breaker, error, start):
+        if self.admission is not None and isinstance(error, HTTPException) and error.status_code == 429:
+            # Being rate limited doesn't mean the provider is down; slow this key down instead
+            breaker.release()
+            self.admission.throttle(target, (error.headers or {}).get("Retry-After"))
+        else:
+            breaker.record(False, time.monotonic() - start)
+
+    async def _attempt(self, target, messages):
+        llm_type, api_key = target
+        breaker = self._breaker(target)
+        deadlines = self._deadlines(llm_type)
+        await self._admit(target, breaker)
+        try:
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(self.call(llm_type, api_key, messages, deadlines), deadlines["total"])
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                self._record_failure(target, breaker, e, start)
+                raise
+            self._record_success(target, breaker, start)
+            return result
+        finally:
+            self._release(target)
+
+    def _hedge_delay(self, target):
+        latency = self._breaker(target).latency_percentile(self.hedge_percentile)
+        return max(latency if latency is not None else self.hedge_min_delay, self.hedge_min_delay)
+
+    def _failure(self, errors, route):
+        """The HTTPException to raise once every provider in the route has failed or been skipped."""
+        if not errors:
+            self.rejected += 1
+            retry_after = min(self._breaker(target).retry_after() for target in route)
+            return HTTPException(status_code=503, detail="All LLM providers are temporarily unavailable",
+                                 headers={"Retry-After": str(retry_after)})
+        error = errors[-1]
+        if isinstance(error, asyncio.TimeoutError):
+            return HTTPException(status_code=504, detail="LLM provider timed out")
+        if isinstance(error, HTTPException) and error.status_code in (429, 503):
+            return error
+        return HTTPException(status_code=502, detail=f"LLM call failed: {getattr(error, 'detail', str(error))}")
+
+    async def complete(self, route, messages):
+        targets = iter(route)
+        pending = {}
+        errors = []
+
+        def launch():
+            for target in targets:
+                if self._breaker(target).allow():
+                    pending[asyncio.create_task(self._attempt(target, messages))] = target
+                    return True
+                logger.info(f"Skipping {target[0]}: circuit open")
+            return False
+
+        if not launch():
+            raise self._failure(errors, route)
+        primary = next(iter(pending.values()))
+        hedge_delay = self._hedge_delay(primary) if self.hedging and len(route) > 1 else None
+        hedged = False
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_delay = None
+                    if launch():
+                        hedged = True
+                        self.hedges += 1
+                        logger.info(f"Hedging slow {primary[0]} call with {list(pending.values())[-1][0]}")
+                    continue
+                for task in done:
+                    target = pending.pop(task)
+                    if task.exception() is None:
+                        if hedged and target != primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append(task.exception())
+                    logger.error(f"{target[0]} call failed: {getattr(task.exception(), 'detail', task.exception())}")
+                if not pending:
+                    hedge_delay = None
+                    if launch():
+                        self.failovers += 1
+            raise self._failure(errors, route)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, route, messages):
+        """Yield text deltas from the first provider in the route that starts answering."""
+        errors = []
+        for target in route:
+            llm_type, api_key = target
+            breaker = self._breaker(target)
+            if not breaker.allow():
+                logger.info(f"Skipping {llm_type}: circuit open")
+                continue
+            if errors:
+                self.failovers += 1
+            try:
+                await self._admit(target, breaker)
+            except HTTPException as e:
+                errors.append(e)
+                continue
+            try:
+                deadlines = self._deadlines(llm_type)
+                start = time.monotonic()
+                tokens = self.stream_call(llm_type, api_key, messages, deadlines)
+                try:
+                    first = await asyncio.wait_for(tokens.__anext__(), deadlines["first_byte"])
+                except StopAsyncIteration:
+                    self._record_success(target, breaker, start)
+                    return
+                except asyncio.CancelledError:
+                    breaker.release()
+                    await tokens.aclose()
+                    raise
+                except Exception as e:
+                    self._record_failure(target, breaker, e, start)
+                    await tokens.aclose()
+                    errors.append(e)
+                    logger.error(f"{llm_type} stream failed before the first token: {getattr(e, 'detail', e)}")
+                    continue
+                # Past the first token the connect/read/total deadlines are enforced by the HTTP client
+                ok = False
+                try:
+                    yield first
+                    async for token in tokens:
+                        yield token
+                    ok = True
+                except (GeneratorExit, asyncio.CancelledError):
+                    # The client went away; that says nothing about the provider's health
+                    breaker.release()
+                    ok = None
+                    raise
+                finally:
+                    if ok:
+                        self._record_success(target, breaker, start)
+                    elif ok is not None:
+                        breaker.record(False, time.monotonic() - start)
+                    await tokens.aclose()
+                return
+            finally:
+                self._release(target)
+        raise self._failure(errors, route)
+
+    def stats(self):
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "rejected": self.rejected,
+            "admission": self.admission.stats() if self.admission is not None else None,
+            "breakers": {f"{llm_type}:{api_key[-4:]}": b.stats() for (llm_type, api_key), b in self.breakers.items()}
+        }
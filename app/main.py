@@ -113,11 +113,14 @@ async def end_session_and_create_ticket():
     full_conversation = "\n".join(formatted_conversation)
     first_message = next((msg["content"] for msg in st.session_state.messages if msg["role"] == "user"), "Chat Session")
     
+    conversation_id = st.session_state.get("conversation_id")
     async with aiohttp.ClientSession() as session:
         ticket_request = {
             "user_id": st.session_state.user.id,
             "agent_id": agent["id"],
             "message": first_message,
+            # The backend prefers the stored conversation and falls back to this transcript if it's gone
+            "conversation_id": conversation_id,
             "response": full_conversation,
             "platform": agent["helpdesk_platform"],
             "department_id": agent.get("helpdesk_department_id", ""),
@@ -128,7 +131,7 @@ async def end_session_and_create_ticket():
         resp = await session.post("http://localhost:8000/create_ticket", json=ticket_request)
         if resp.status == 200:
             ticket_data = await resp.json()
-            logger.info(f"Session-end ticket created: {ticket_data}")
+            logger.info(f"Session-end ticket queued: job {ticket_data['job_id']}")
         else:
             error_text = await resp.text()
             logger.error(f"Session-end ticket creation failed: {error_text}")
@@ -189,6 +192,31 @@ def load_agents(user_id):
             return data["agents"]
     return asyncio.run(fetch_agents())
 
+RAG_FILE_TYPES = ["txt", "pdf", "zip", "tar", "gz", "tgz", "bz2"]
+
+def upload_rag_files(user_id, agent_id, files):
+    """Send all selected files (and archives) to the bulk endpoint in one request and report each result."""
+    async def upload_async():
+        form_data = FormData()
+        form_data.add_field("user_id", user_id)
+        form_data.add_field("agent_id", agent_id)
+        for f in files:
+            form_data.add_field("files", f, filename=f.name)
+        async with aiohttp.ClientSession() as session:
+            resp = await session.post("http://localhost:8000/upload_rag_bulk", data=form_data)
+            if resp.status != 200:
+                logger.error(f"Bulk RAG upload failed: {await resp.text()}")
+                return None
+            return await resp.json()
+    result = asyncio.run(upload_async())
+    if result is None:
+        st.error("RAG upload failed. Check logs for details.")
+        return
+    st.success(result.get("message", "RAG files uploaded successfully"))
+    for r in result["results"]:
+        if r["status"] not in ("stored", "unchanged"):
+            st.warning(f"{r['filename']}: {r['error']}")
+
 with st.sidebar:
     st.title("🤖 CogniCrew")
     if not st.session_state.user:
@@ -343,7 +371,11 @@ if st.session_state.user:
                             "agents": st.session_state.agents,
                             "customer_email": st.session_state.customer_email,
                             "customer_name": st.session_state.customer_name,
-                            "history": st.session_state.messages,
+                            # A fresh transcript here means a new conversation; otherwise the server has the history
+                            "conversation_id": st.session_state.get("conversation_id") if len(st.session_state.messages) > 1 else None,
+                            # Once the server has lost the conversation, the transcript goes with each message instead
+                            "history": [{"role": m["role"], "content": m["content"]} for m in st.session_state.messages[:-1]]
+                                       if len(st.session_state.messages) > 1 and st.session_state.get("send_history") else [],
                             "language": st.session_state.current_language,
                             "department": st.session_state.selected_department  # Pass selected department
                         }
@@ -355,6 +387,9 @@ if st.session_state.user:
                             return {"responses": [], "rag_context": ""}
                         response = await resp.json()
                         logger.info(f"Chat response received: {response}")
+                        st.session_state.conversation_id = response.get("conversation_id")
+                        st.session_state.send_history = bool(response.get("conversation_reset")) or (
+                            len(st.session_state.messages) > 1 and st.session_state.get("send_history", False))
                         return response
                 
                 with st.spinner("Thinking..."):
@@ -387,8 +422,9 @@ if st.session_state.user:
         agent_llm = st.selectbox("LLM", ["deepseek", "gpt", "grok", "gemini"])
         agent_key = st.text_input("API Key", type="password")
         agent_rag_only = st.checkbox("RAG-Only", value=True, disabled=True)
+        agent_answer_cache = st.checkbox("Reuse answers to repeated questions", value=False)
         agent_avatar = st.file_uploader("Agent Avatar (optional)", type=["png", "jpg", "jpeg"], key="new_avatar")
-        agent_file = st.file_uploader("Upload RAG File", type=["txt", "pdf"])
+        agent_files = st.file_uploader("Upload RAG Files", type=RAG_FILE_TYPES, accept_multiple_files=True)
         
         st.subheader("Helpdesk Integration (Optional)")
         helpdesk_platform = st.selectbox("Helpdesk Platform", ["None", "Zendesk", "Zoho Desk"])
@@ -438,7 +474,8 @@ if st.session_state.user:
                         "helpdesk_org_id": helpdesk_org_id,
                         "helpdesk_department_id": helpdesk_department_id,
                         "helpdesk_subdomain": helpdesk_subdomain,
-                        "create_tickets": create_tickets
+                        "create_tickets": create_tickets,
+                        "answer_cache": agent_answer_cache
                     }
                     async def add_async():
                         async with aiohttp.ClientSession() as session:
@@ -454,17 +491,8 @@ if st.session_state.user:
                         new_agent["id"] = result["agent"]["id"]
                         st.session_state.agents.append(result["agent"])
                         st.success(result.get("message", f"Added {agent_name} successfully"))
-                        if agent_file:
-                            async def upload_rag_async():
-                                form_data = FormData()
-                                form_data.add_field("user_id", st.session_state.user.id)
-                                form_data.add_field("agent_id", new_agent["id"])
-                                form_data.add_field("file", agent_file, filename=agent_file.name)
-                                async with aiohttp.ClientSession() as session:
-                                    resp = await session.post("http://localhost:8000/upload_rag", data=form_data)
-                                    return await resp.json()
-                            result = asyncio.run(upload_rag_async())
-                            st.success(result.get("message", "RAG file uploaded successfully"))
+                        if agent_files:
+                            upload_rag_files(st.session_state.user.id, new_agent["id"], agent_files)
                         if agent_avatar:
                             async def upload_avatar_async():
                                 form_data = FormData()
@@ -506,6 +534,7 @@ if st.session_state.user:
                 edit_llm = st.selectbox(f"Edit LLM", ["deepseek", "gpt", "grok", "gemini"], index=["deepseek", "gpt", "grok", "gemini"].index(agent["llm_type"]), key=f"edit_llm_{i}")
                 edit_key = st.text_input(f"Edit API Key", agent["api_key"], type="password", key=f"edit_key_{i}")
                 edit_rag_only = st.checkbox(f"Edit RAG-Only", value=True, disabled=True, key=f"edit_rag_{i}")
+                edit_answer_cache = st.checkbox(f"Edit Reuse Answers", value=agent.get("answer_cache", False), key=f"edit_answer_cache_{i}")
                 
                 platform_map = {"none": "None", "zendesk": "Zendesk", "zoho desk": "Zoho Desk"}
                 current_platform = platform_map.get(agent["helpdesk_platform"].lower(), "None")
@@ -578,18 +607,9 @@ if st.session_state.user:
                 else:
                     st.write("No RAG files attached.")
                 
-                new_rag_file = st.file_uploader(f"Add RAG File for {agent['name']}", type=["txt", "pdf"], key=f"new_rag_{i}")
-                if new_rag_file and st.button(f"Upload for {agent['name']}", key=f"upload_rag_{i}"):
-                    async def upload_async():
-                        form_data = FormData()
-                        form_data.add_field("user_id", st.session_state.user.id)
-                        form_data.add_field("agent_id", agent["id"])
-                        form_data.add_field("file", new_rag_file, filename=new_rag_file.name)
-                        async with aiohttp.ClientSession() as session:
-                            resp = await session.post("http://localhost:8000/upload_rag", data=form_data)
-                            return await resp.json()
-                    result = asyncio.run(upload_async())
-                    st.success(result.get("message", "RAG file uploaded successfully"))
+                new_rag_files = st.file_uploader(f"Add RAG Files for {agent['name']}", type=RAG_FILE_TYPES, accept_multiple_files=True, key=f"new_rag_{i}")
+                if new_rag_files and st.button(f"Upload for {agent['name']}", key=f"upload_rag_{i}"):
+                    upload_rag_files(st.session_state.user.id, agent["id"], new_rag_files)
                     st.rerun()
                 
                 st.subheader(f"Deploy {agent['name']} on Your Website")
@@ -628,7 +648,8 @@ if st.session_state.user:
                             "helpdesk_org_id": edit_helpdesk_org_id,
                             "helpdesk_department_id": edit_helpdesk_department_id,
                             "helpdesk_subdomain": edit_helpdesk_subdomain,
-                            "create_tickets": edit_create_tickets
+                            "create_tickets": edit_create_tickets,
+                            "answer_cache": edit_answer_cache
                         }
                         async def update_async():
                             async with aiohttp.ClientSession() as session:
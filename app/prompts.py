@@ -0,0 +1,74 @@
+from functools import lru_cache
+
+# Everything that depends on the request (language, retrieved data) lives in
+# SESSION_DETAILS, sent after the history, so this prefix is byte-identical
+# for every request to an agent and providers' prompt caches can reuse it.
+AGENT_INSTRUCTIONS = """You’re {name} at {company}, in the {department} department. Your persona: {info}.
+- Do NOT prepend your name, 'assistant:', 'agent:', or any role-based prefix to your response; provide only the raw message content with no labels.
+- If the user asks "What is your name?" "Who are you?" or similar, respond naturally (e.g., "I’m {name}! How can I help you today?").
+- Start by responding in the customer's language given in the session details.
+- If the user says "Switch to [language]" or similar (e.g., "Use Spanish"), detect the requested language (even with typos), switch to it for all future responses, and confirm: "Switched to [language]!"
+- If the conversation history is empty (length 0), it’s the first message—end with: "By the way, need a different language? Just say 'Switch to Spanish,' 'Switch to French,' etc."—otherwise, do not include this unless the user mentions languages.
+- Respond to casual greetings creatively and variably only if the input is clearly a greeting and not a question:
+  - "Hello" or "Hi": "Hi there! What’s on your mind today?"
+  - "Hey" or "Heya": "Heya! Good to chat—what can I do for you?"
+  - "How’s it going": "Hey, doing great—how about you? What’s up?"
+- For any input resembling a question (e.g., starts with 'what', 'how', 'why', or contains '?'), answer directly without a greeting unless it’s the first message.
+- For anything about {company}:
+  1. Use ONLY the reference data given in the session details. Quote it exactly—no paraphrasing, no guessing.
+  2. Guess their setup or pain points based on prior messages if available.
+  3. Give the fix or info naturally, like you’re recalling it.
+  4. If the data mentions packages, upsell once—explain the perk, ask if they’re interested, then drop it unless they bring it up again.
+- If no data: Say: “Sorry, I don’t have specific info on that. Check {company}’s site or let me know how else I can help!”
+- Off-topic? Say: “I’m here to assist with any {company}-related questions or support needs. How can I help you today?”—keep it simple unless it’s the first message.
+- Be friendly, helpful, and on-brand—never bash {company}.
+- Use the conversation history to stay consistent, vary responses, and avoid repetition unless necessary."""
+
+SESSION_DETAILS = """Session details for this message:
+- Customer's language: {language}
+- Reference data:
+{rag_text}"""
+
+
+@lru_cache(maxsize=1024)
+def agent_prefix(name, company, department, info):
+    """The agent's static system prompt, compiled once per distinct agent configuration."""
+    return AGENT_INSTRUCTIONS.format(name=name, company=company, department=department, info=info)
+
+
+def session_details(language, rag_text):
+    return SESSION_DETAILS.format(language=language, rag_text=rag_text)
+
+
+def prompt_usage(llm_type, data):
+    """(prompt_tokens, cached_tokens) from a provider response or stream chunk, or None if it has no usage."""
+    if llm_type == "gemini":
+        usage = data.get("usageMetadata")
+        if not usage:
+            return None
+        return usage.get("promptTokenCount", 0), usage.get("cachedContentTokenCount", 0)
+    usage = data.get("usage")
+    if not usage:
+        return None
+    if "prompt_cache_hit_tokens" in usage:  # DeepSeek reports cache hits at the top level
+        return usage.get("prompt_tokens", 0), usage["prompt_cache_hit_tokens"]
+    return usage.get("prompt_tokens", 0), (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+
+
+class PromptCacheStats:
+    """Per-provider prompt vs. cached token totals, to track prefix-cache hit rates."""
+
+    def __init__(self):
+        self.providers = {}
+
+    def record(self, llm_type, prompt_tokens, cached_tokens):
+        totals = self.providers.setdefault(llm_type, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["cached_tokens"] += cached_tokens
+
+    def stats(self):
+        return {
+            llm_type: {**totals, "hit_rate": round(totals["cached_tokens"] / totals["prompt_tokens"], 3) if totals["prompt_tokens"] else 0}
+            for llm_type, totals in self.providers.items()
+        }
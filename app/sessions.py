@@ -0,0 +1,86 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+from .caches import LRUCache
+
+
+class MemorySessionStore:
+    """Conversation turns kept in process memory.
+
+    Least-recently-used conversations are evicted beyond max_conversations,
+    and a conversation expires ttl seconds after its last turn. Conversations
+    live in one process: with several uvicorn workers use SupabaseSessionStore.
+    """
+
+    def __init__(self, max_conversations=10000, ttl=86400):
+        self.conversations = LRUCache(max_conversations, ttl=ttl)
+
+    async def create(self, user_id):
+        conversation_id = str(uuid.uuid4())
+        self.conversations.set(conversation_id, {"id": conversation_id, "user_id": user_id, "turns": []})
+        return conversation_id
+
+    async def get(self, conversation_id):
+        return self.conversations.get(conversation_id)
+
+    async def append(self, conversation_id, turns):
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return
+        conversation["turns"].extend(turns)
+        # Re-set so the expiry counts from the latest turn
+        self.conversations.set(conversation_id, conversation)
+
+    def stats(self):
+        return {"backend": "memory", **self.conversations.stats()}
+
+
+class SupabaseSessionStore:
+    """Conversation turns stored in the conversations / conversation_turns tables.
+
+    Every worker sees the same conversations and they survive restarts, at
+    the cost of two small queries per read. Expiry is left to the database
+    (e.g. a scheduled delete on conversations.updated_at).
+    """
+
+    def __init__(self, db, client):
+        self.db = db
+        self.client = client
+        self.loads = 0
+        self.appends = 0
+
+    async def create(self, user_id):
+        conversation_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        await self.db.execute(self.client.table("conversations").insert({
+            "id": conversation_id, "user_id": user_id, "created_at": now, "updated_at": now
+        }))
+        return conversation_id
+
+    async def get(self, conversation_id):
+        try:
+            uuid.UUID(conversation_id)
+        except ValueError:
+            return None
+        conversation, turns = await asyncio.gather(
+            self.db.execute(self.client.table("conversations").select("id, user_id").eq("id", conversation_id)),
+            self.db.execute(
+                self.client.table("conversation_turns").select("role, content").eq("conversation_id", conversation_id).order("id")
+            )
+        )
+        if not conversation.data:
+            return None
+        self.loads += 1
+        return {**conversation.data[0], "turns": turns.data}
+
+    async def append(self, conversation_id, turns):
+        now = datetime.now().isoformat()
+        await self.db.execute(self.client.table("conversation_turns").insert([
+            {"conversation_id": conversation_id, "role": t["role"], "content": t["content"], "created_at": now} for t in turns
+        ]))
+        await self.db.execute(self.client.table("conversations").update({"updated_at": now}).eq("id", conversation_id))
+        self.appends += 1
+
+    def stats(self):
+        return {"backend": "supabase", "loads": self.loads, "appends": self.appends}
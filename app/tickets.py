@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import aiohttp
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+def _parse(timestamp):
+    # Written with _now(); compare on the same naive wall clock whatever offset Postgres echoes back
+    return datetime.fromisoformat(timestamp).replace(tzinfo=None) if timestamp else None
+
+
+class TicketQueue:
+    """Durable background queue for helpdesk ticket creation.
+
+    Jobs are written to the ticket_jobs table before they're acknowledged, so
+    a restart picks up anything that hadn't finished. A pool of workers runs
+    handler(payload) for each job, at most platform_concurrency at a time per
+    helpdesk platform. Rate limits (429), server errors (5xx) and network
+    failures are retried with exponential backoff and jitter, honouring
+    Retry-After when the platform sends one; other errors fail the job.
+
+    Several server processes can share the table. A "running" job whose
+    claim is older than lease_timeout belonged to a process that died
+    mid-job: every process sweeps for those every lease_timeout / 2 and
+    requeues them, so they're picked up even after a quick restart. Jobs
+    recovered at start still wait out their next_attempt_at.
+    """
+
+    def __init__(self, db, client, handler, workers=4, platform_concurrency=2, max_attempts=6,
+                 backoff_base=2.0, backoff_max=300.0, lease_timeout=300.0, table="ticket_jobs"):
+        self.db = db
+        self.client = client
+        self.handler = handler
+        self.workers = workers
+        self.platform_concurrency = platform_concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_timeout = lease_timeout
+        self.table = table
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self._queue = None
+        self._tasks = []
+        self._timers = set()
+        self.reclaimed = 0
+        self._platform_limits = {}
+
+    async def enqueue(self, platform, payload):
+        response = await self.db.execute(self.client.table(self.table).insert({
+            "status": "queued",
+            "platform": platform,
+            "payload": payload,
+            "attempts": 0,
+            "created_at": _now(),
+            "updated_at": _now()
+        }))
+        job_id = response.data[0]["id"]
+        self._queue.put_nowait({"id": job_id, "platform": platform, "payload": payload, "attempts": 0})
+        return job_id
+
+    async def status(self, job_id):
+        try:
+            uuid.UUID(job_id)
+        except ValueError:
+            return None
+        response = await self.db.execute(
+            self.client.table(self.table)
+            .select("id, status, platform, attempts, result, error, created_at, updated_at, next_attempt_at")
+            .eq("id", job_id)
+        )
+        return response.data[0] if response.data else None
+
+    async def _update(self, job_id, **fields):
+        try:
+            return await self.db.execute(
+                self.client.table(self.table).update({**fields, "updated_at": _now()}).eq("id", job_id)
+            )
+        except Exception as e:
+            logger.error(f"Failed to update ticket job {job_id}: {e}")
+            return None
+
+    async def _claim(self, job):
+        # Conditional update so a job is only ever processed by one worker/process at a time
+        response = await self.db.execute(
+            self.client.table(self.table)
+            .update({"status": "running", "attempts": job["attempts"], "updated_at": _now()})
+            .eq("id", job["id"])
+            .in_("status", ["queued", "retrying"])
+        )
+        return bool(response.data)
+
+    def _retry_delay(self, error, attempts):
+        """Seconds to wait before retrying, or None if the error isn't retryable."""
+        if isinstance(error, HTTPException):
+            if error.status_code != 429 and error.status_code < 500:
+                return None
+            retry_after = (error.headers or {}).get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        elif not isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+            return None
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _schedule(self, job, delay):
+        task = asyncio.create_task(self._requeue_later(job, delay))
+        self._timers.add(task)
+        task.add_done_callback(self._timers.discard)
+
+    async def _requeue_later(self, job, delay):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(job)
+
+    async def _process(self, job):
+        job["attempts"] += 1
+        try:
+            if not await self._claim(job):
+                return
+        except Exception as e:
+            logger.error(f"Failed to claim ticket job {job['id']}: {e}")
+            self._schedule(job, self.backoff_base)
+            return
+        try:
+            result = await self.handler(job["payload"])
+        except Exception as e:
+            detail = str(getattr(e, "detail", e))
+            delay = self._retry_delay(e, job["attempts"])
+            if delay is None or job["attempts"] >= self.max_attempts:
+                self.failed += 1
+                logger.error(f"Ticket job {job['id']} failed after {job['attempts']} attempt(s): {detail}")
+                await self._update(job["id"], status="failed", error=detail)
+                return
+            self.retried += 1
+            logger.info(f"Ticket job {job['id']} attempt {job['attempts']} failed ({detail}); retrying in {delay:.1f}s")
+            await self._update(
+                job["id"], status="retrying", error=detail,
+                next_attempt_at=(datetime.now() + timedelta(seconds=delay)).isoformat()
+            )
+            self._schedule(job, delay)
+            return
+        self.succeeded += 1
+        await self._update(job["id"], status="succeeded", result=result, error=None)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            limit = self._platform_limits.setdefault(job["platform"], asyncio.Semaphore(self.platform_concurrency))
+            async with limit:
+                try:
+                    await self._process(job)
+                except Exception as e:
+                    logger.error(f"Ticket worker error on job {job['id']}: {e}")
+
+    async def _reset_expired(self):
+        """Set "running" jobs claimed longer ago than the lease back to "retrying"; returns their rows.
+
+        Newer "running" jobs belong to live processes (possibly this one).
+        """
+        expired = (datetime.now() - timedelta(seconds=self.lease_timeout)).isoformat()
+        response = await self.db.execute(
+            self.client.table(self.table).update({"status": "retrying", "updated_at": _now()})
+            .eq("status", "running").lt("updated_at", expired)
+        )
+        self.reclaimed += len(response.data or [])
+        return response.data or []
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.lease_timeout / 2)
+            try:
+                rows = await self._reset_expired()
+            except Exception as e:
+                logger.error(f"Failed to sweep expired ticket jobs: {e}")
+                continue
+            for row in rows:
+                self._queue.put_nowait({"id": row["id"], "platform": row["platform"], "payload": row["payload"], "attempts": row["attempts"]})
+            if rows:
+                logger.info(f"Requeued {len(rows)} ticket jobs whose lease expired")
+
+    async def _recover(self):
+        await self._reset_expired()
+        response = await self.db.execute(
+            self.client.table(self.table).select("id, platform, payload, attempts, next_attempt_at").in_("status", ["queued", "retrying"])
+        )
+        now = datetime.now()
+        for row in response.data:
+            job = {"id": row["id"], "platform": row["platform"], "payload": row["payload"], "attempts": row["attempts"]}
+            next_attempt = _parse(row.get("next_attempt_at"))
+            if next_attempt is not None and next_attempt > now:
+                self._schedule(job, (next_attempt - now).total_seconds())
+            else:
+                self._queue.put_nowait(job)
+        if response.data:
+            logger.info(f"Recovered {len(response.data)} pending ticket jobs")
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        try:
+            await self._recover()
+        except Exception as e:
+            logger.error(f"Failed to recover pending ticket jobs: {e}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        for task in list(self._timers):
+            task.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+            "reclaimed": self.reclaimed
+        }
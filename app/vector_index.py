@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # optional: large partitions fall back to exact search
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+
+def _as_vector(embedding):
+    # pgvector columns come back from PostgREST as "[0.1,0.2,...]" strings
+    if isinstance(embedding, str):
+        embedding = json.loads(embedding)
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _build_ann(vectors, labels, ef_construction, m, ef_search):
+    """Build an HNSW graph over a snapshot of a partition (runs off the event loop)."""
+    index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+    index.init_index(max_elements=len(labels), ef_construction=ef_construction, M=m)
+    index.add_items(vectors, labels)
+    index.set_ef(ef_search)
+    return index
+
+
+def _prepare_rows(rows):
+    """Parse and normalise the rows' embeddings and strip them from the rows (runs off the event loop)."""
+    vectors = np.vstack([_as_vector(r["embedding"]) for r in rows])
+    return vectors, [{k: v for k, v in r.items() if k != "embedding"} for r in rows]
+
+
+def _ann_add(index, vectors, labels):
+    needed = index.get_current_count() + len(labels)
+    if needed > index.get_max_elements():
+        index.resize_index(max(needed, 2 * index.get_max_elements()))
+    index.add_items(vectors, labels)
+
+
+class _Partition:
+    def __init__(self, dim):
+        self.rows = []
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        # Stable per-row labels for the HNSW graph, so removals only mark rows deleted there
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.positions = {}  # label -> row position
+        self.next_label = 0
+        self.ann = None
+        self.ann_deleted = 0
+        self.building = False
+        # The graph new rows are going into on a worker thread: searches skip it and deletions wait
+        self.inserting = None
+        self.pending_deletes = []
+        self.lock = asyncio.Lock()
+
+    async def add(self, rows, vectors):
+        """Append rows; the copy into the partition's arrays and the graph insert run on worker threads."""
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            labels = np.arange(self.next_label, self.next_label + len(rows), dtype=np.int64)
+            self.next_label += len(rows)
+            snapshot = self.vectors
+            stacked = await loop.run_in_executor(None, np.vstack, [snapshot, vectors])
+            if self.vectors is not snapshot:
+                stacked = np.vstack([self.vectors, vectors])  # rows were removed meanwhile
+            start = len(self.rows)
+            self.rows.extend(rows)
+            self.vectors = stacked
+            self.labels = np.concatenate([self.labels, labels])
+            self.positions.update({int(label): start + i for i, label in enumerate(labels)})
+            index = self.ann
+            if index is None:
+                return
+            self.inserting = index
+            try:
+                await loop.run_in_executor(None, _ann_add, index, vectors, labels)
+            finally:
+                self.inserting = None
+                for label in self.pending_deletes:
+                    index.mark_deleted(label)
+                self.pending_deletes = []
+
+    def remove(self, predicate):
+        keep = [i for i, row in enumerate(self.rows) if not predicate(row)]
+        removed = len(self.rows) - len(keep)
+        if removed:
+            if self.ann is not None:
+                kept = set(keep)
+                deleted = [int(self.labels[i]) for i in range(len(self.rows)) if i not in kept]
+                if self.ann is self.inserting:
+                    self.pending_deletes.extend(deleted)  # hnswlib can't mark_deleted during add_items
+                else:
+                    for label in deleted:
+                        self.ann.mark_deleted(label)
+                self.ann_deleted += removed
+            self.rows = [self.rows[i] for i in keep]
+            self.vectors = self.vectors[keep]
+            self.labels = self.labels[keep]
+            self.positions = {int(label): i for i, label in enumerate(self.labels)}
+        return removed
+
+    def finish_ann(self, index, built_labels):
+        """Install a graph built from an earlier snapshot, catching it up with rows added or removed since."""
+        added = np.setdiff1d(self.labels, built_labels, assume_unique=True)
+        deleted = np.setdiff1d(built_labels, self.labels, assume_unique=True)
+        if len(added):
+            _ann_add(index, self.vectors[[self.positions[int(label)] for label in added]], added)
+        for label in deleted:
+            index.mark_deleted(int(label))
+        self.ann = index
+        self.ann_deleted = len(deleted)
+
+    def search(self, query, limit, use_ann):
+        if not self.rows:
+            return []
+        k = min(limit, len(self.rows))
+        if use_ann:
+            labels, distances = self.ann.knn_query(query, k=k)
+            # hnswlib's "ip" distance is 1 - inner product
+            return [(self.positions[int(label)], 1.0 - float(d)) for label, d in zip(labels[0], distances[0])]
+        scores = self.vectors @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+
+class LocalVectorIndex:
+    """In-process chunk index partitioned by (user_id, agent_id).
+
+    Small partitions use exact brute-force cosine similarity in NumPy. Once a
+    partition has ann_threshold chunks (and hnswlib is installed) an HNSW
+    graph is built for it on a background thread, and it is served from the
+    graph once that's ready; until then searches stay exact. Added rows are
+    parsed, copied in and inserted into the graph on worker threads too, with
+    searches kept exact while an insert runs. Removed rows are
+    only marked deleted in the graph, which is rebuilt the same way once
+    deleted rows outnumber live ones. search returns rows in the same shape
+    as the match_rag_chunks RPC so SupabaseVectorStore can use either backend.
+
+    The index lives in one process: with several uvicorn workers each keeps
+    its own copy, and only the worker that handled an upload or delete sees
+    it until the others restart.
+    """
+
+    def __init__(self, ann_threshold=20000, ef_construction=200, m=16, ef_search=64):
+        self.ann_threshold = ann_threshold
+        self.ef_construction = ef_construction
+        self.m = m
+        self.ef_search = ef_search
+        self.partitions = {}
+        self.builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ann-build")
+        if hnswlib is None:
+            logger.info("hnswlib not installed; local vector index will use exact search only")
+
+    async def add(self, user_id, agent_id, rows):
+        """Add chunk rows (match_rag_chunks fields plus "embedding")."""
+        if not rows:
+            return
+        vectors, rows = await asyncio.get_running_loop().run_in_executor(None, _prepare_rows, rows)
+        key = (user_id, agent_id)
+        if key not in self.partitions:
+            self.partitions[key] = _Partition(vectors.shape[1])
+        await self.partitions[key].add(rows, vectors)
+
+    def remove_file(self, user_id, agent_id, file_path):
+        partition = self.partitions.get((user_id, agent_id))
+        if partition is None:
+            return 0
+        return partition.remove(lambda row: row["file_path"] == file_path)
+
+    def search(self, query_embedding, user_id, agent_id=None, limit=3):
+        query = _as_vector(query_embedding)
+        if agent_id is not None:
+            keys = [(user_id, agent_id)] if (user_id, agent_id) in self.partitions else []
+        else:
+            keys = [key for key in self.partitions if key[0] == user_id]
+        hits = []
+        for key in keys:
+            partition = self.partitions[key]
+            self._maybe_build(partition)
+            use_ann = partition.ann is not None and partition.ann is not partition.inserting and len(partition.rows) >= self.ann_threshold
+            for i, similarity in partition.search(query, limit, use_ann):
+                hits.append({**partition.rows[i], "similarity": similarity})
+        hits.sort(key=lambda h: h["similarity"], reverse=True)
+        return hits[:limit]
+
+    def _maybe_build(self, partition):
+        if hnswlib is None or partition.building or len(partition.rows) < self.ann_threshold:
+            return
+        if partition.ann is not None and partition.ann_deleted <= len(partition.rows):
+            return
+        partition.building = True
+        vectors, labels = partition.vectors, partition.labels  # replaced, never mutated, by add/remove
+        loop = asyncio.get_running_loop()
+
+        def finish(future):
+            partition.building = False
+            try:
+                partition.finish_ann(future.result(), labels)
+            except Exception as e:
+                logger.error(f"Building the HNSW index for a partition failed: {e}")
+
+        future = self.builder.submit(_build_ann, vectors, labels, self.ef_construction, self.m, self.ef_search)
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(finish, f))
+
+    def stats(self):
+        return {
+            "partitions": len(self.partitions),
+            "chunks": sum(len(p.rows) for p in self.partitions.values()),
+            "ann_partitions": sum(1 for p in self.partitions.values() if p.ann is not None),
+            "ann_building": sum(1 for p in self.partitions.values() if p.building),
+            "ann_inserting": sum(1 for p in self.partitions.values() if p.inserting is not None)
+        }
@@ -0,0 +1,68 @@
+"""Compare query-embedding throughput: one encode per request vs EmbeddingBatcher.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_embedding_batcher --concurrency 50 --rounds 5
+"""
+import argparse
+import asyncio
+import time
+
+from sentence_transformers import SentenceTransformer
+
+from app.embedding import EmbeddingBatcher
+
+
+def make_queries(n, round_no):
+    # Unique texts so neither path can benefit from any caching
+    return [f"How do I change the billing plan for account {round_no}-{i}?" for i in range(n)]
+
+
+async def run_unbatched(embedder, concurrency, rounds):
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    for r in range(rounds):
+        await asyncio.gather(*(
+            loop.run_in_executor(None, lambda q=q: embedder.encode(q).tolist())
+            for q in make_queries(concurrency, r)
+        ))
+    return time.perf_counter() - start
+
+
+async def run_batched(embedder, concurrency, rounds, max_batch_size, window_ms):
+    batcher = EmbeddingBatcher(embedder, max_batch_size=max_batch_size, batch_window_ms=window_ms)
+    batcher.start()
+    await batcher.encode("warmup")
+    start = time.perf_counter()
+    for r in range(rounds):
+        await asyncio.gather(*(batcher.encode(q) for q in make_queries(concurrency, r)))
+    elapsed = time.perf_counter() - start
+    stats = batcher.stats()
+    await batcher.stop()
+    return elapsed, stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--window-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    embedder = SentenceTransformer(args.model)
+    embedder.encode("warmup")
+    total = args.concurrency * args.rounds
+
+    unbatched = await run_unbatched(embedder, args.concurrency, args.rounds)
+    batched, stats = await run_batched(embedder, args.concurrency, args.rounds, args.max_batch_size, args.window_ms)
+
+    print(f"{total} queries, {args.concurrency} concurrent")
+    print(f"unbatched: {unbatched:.2f}s  {total / unbatched:8.1f} queries/s")
+    print(f"batched:   {batched:.2f}s  {total / batched:8.1f} queries/s  (avg batch {stats['avg_batch_size']})")
+    print(f"speedup:   {unbatched / batched:.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
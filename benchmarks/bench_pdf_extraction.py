@@ -0,0 +1,122 @@
+"""Compare PDF text extraction: the old per-page re-parse, a single parse on the event loop,
+and DocumentExtractor's process pool, on a generated multi-hundred-page PDF.
+
+Besides wall time it reports the event loop's worst stall while extraction runs,
+which is what every other request on the server waits behind.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pdf_extraction --pages 400 --documents 4
+"""
+import argparse
+import asyncio
+import io
+import time
+
+import PyPDF2
+
+from app.extraction import DocumentExtractor
+from app.ingest import extract_text
+
+
+def make_pdf(pages, lines_per_page=40):
+    """A plain-text PDF with `pages` pages, built by hand so the benchmark needs no PDF writer."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for p in range(pages):
+        lines = [f"Page {p + 1} line {i + 1}: order AB-{p * 100 + i} ships within {i % 7 + 1} business days."
+                 for i in range(lines_per_page)]
+        text = " T* ".join(f"({line})Tj" for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 40 800 Td {text} ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def legacy_extract(content):
+    # The expression upload_rag used to run: a fresh PdfReader for every page, plus one for the count
+    return "".join(PyPDF2.PdfReader(io.BytesIO(content)).pages[i].extract_text()
+                   for i in range(len(PyPDF2.PdfReader(io.BytesIO(content)).pages)))
+
+
+async def measure(work):
+    """Run work() and report (seconds, worst event-loop stall in seconds)."""
+    stall = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal stall
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stall = max(stall, time.perf_counter() - before - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - start
+    running = False
+    await tick
+    return elapsed, stall
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--documents", type=int, default=4, help="PDFs extracted concurrently in the pool run")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--skip-legacy", action="store_true", help="skip the quadratic baseline on very large PDFs")
+    args = parser.parse_args()
+
+    content = make_pdf(args.pages)
+    print(f"{args.pages}-page PDF, {len(content) / 1024:.0f} KB")
+
+    if not args.skip_legacy:
+        async def legacy():
+            legacy_extract(content)
+        elapsed, stall = await measure(legacy)
+        print(f"legacy re-parse on loop:   {elapsed:7.2f}s  loop stall {stall:6.2f}s")
+
+    async def single():
+        extract_text("bench.pdf", content)
+    elapsed, stall = await measure(single)
+    print(f"single parse on loop:      {elapsed:7.2f}s  loop stall {stall:6.2f}s")
+
+    extractor = DocumentExtractor(max_workers=args.workers, timeout=600, cpu_seconds=600)
+    await extractor.extract("warmup.txt", b"warmup")  # spawn a worker outside the timing
+
+    async def pooled():
+        await extractor.extract("bench.pdf", content)
+    elapsed, stall = await measure(pooled)
+    print(f"process pool, 1 document:  {elapsed:7.2f}s  loop stall {stall:6.2f}s")
+
+    async def pooled_many():
+        await asyncio.gather(*(extractor.extract(f"bench{i}.pdf", content) for i in range(args.documents)))
+    elapsed, stall = await measure(pooled_many)
+    print(f"process pool, {args.documents} documents: {elapsed:7.2f}s  loop stall {stall:6.2f}s")
+    extractor.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+-- Database objects used by app/backend.py in addition to the original
+-- agents, rag_metadata and query_embeddings tables. Run in the Supabase SQL editor.
+
+-- Chunk-level RAG storage: one row per overlapping chunk of a file in rag_metadata.
+-- rag_id must use the same type as rag_metadata.id.
+create table if not exists rag_chunks (
+    id bigserial primary key,
+    rag_id uuid not null references rag_metadata (id) on delete cascade,
+    user_id text not null,
+    agent_id text,
+    file_path text not null,
+    chunk_index int not null,
+    start_offset int not null,
+    end_offset int not null,
+    content text not null,
+    embedding vector(384) not null
+);
+
+create index if not exists rag_chunks_owner_idx on rag_chunks (user_id, agent_id);
+create index if not exists rag_chunks_embedding_idx on rag_chunks using hnsw (embedding vector_cosine_ops);
+
+create or replace function match_rag_chunks(query_embedding vector(384), user_id text, agent_id text, match_limit int)
+returns table (
+    id bigint,
+    rag_id uuid,
+    file_path text,
+    chunk_index int,
+    start_offset int,
+    end_offset int,
+    content text,
+    metadata jsonb,
+    similarity float
+)
+language sql stable
+as $$
+    select c.id, c.rag_id, c.file_path, c.chunk_index, c.start_offset, c.end_offset, c.content, m.metadata,
+           1 - (c.embedding <=> query_embedding) as similarity
+    from rag_chunks c
+    join rag_metadata m on m.id = c.rag_id
+    where c.user_id = match_rag_chunks.user_id
+      and (match_rag_chunks.agent_id is null or c.agent_id = match_rag_chunks.agent_id)
+    order by c.embedding <=> query_embedding
+    limit match_limit;
+$$;
+
+-- Plain text extracted at upload time, so queries never download or re-parse the original file.
+alter table rag_metadata add column if not exists content text;
+
+-- Durable queue for helpdesk ticket creation (see app/tickets.py).
+create table if not exists ticket_jobs (
+    id uuid primary key default gen_random_uuid(),
+    status text not null,
+    platform text not null,
+    payload jsonb not null,
+    attempts int not null default 0,
+    result jsonb,
+    error text,
+    next_attempt_at timestamptz,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists ticket_jobs_pending_idx on ticket_jobs (status) where status in ('queued', 'retrying', 'running');
+
+-- Per-agent opt-in for the semantic answer cache (see app/answer_cache.py).
+alter table agents add column if not exists answer_cache boolean not null default false;
+
+-- Server-side chat sessions for SESSION_STORE=supabase (see app/sessions.py).
+create table if not exists conversations (
+    id uuid primary key,
+    user_id text not null,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create table if not exists conversation_turns (
+    id bigserial primary key,
+    conversation_id uuid not null references conversations (id) on delete cascade,
+    role text not null,
+    content text not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists conversation_turns_conversation_idx on conversation_turns (conversation_id, id);
+
+-- Per-agent overrides for retrieved-context assembly; null means the server defaults.
+alter table agents add column if not exists context_token_budget int;
+alter table agents add column if not exists context_min_similarity real;
+
+-- Per-agent LLM fallback chain: [{"llm_type": "...", "api_key": "..."}], tried in order (see app/llm_router.py).
+alter table agents add column if not exists fallbacks jsonb not null default '[]'::jsonb;
+
+-- Hash of the uploaded file, so re-uploads of an unchanged document are skipped; a document is its filename within an agent.
+alter table rag_metadata add column if not exists content_hash text;
+create index if not exists rag_metadata_document_idx on rag_metadata (user_id, agent_id, (metadata->>'filename'));
@@ -34,6 +34,8 @@
             agentInfo: { name: null, avatar: null, id: null }, // Will be set based on selected department
             customerInfo: { name: null, email: null, language: "English", department: null },
             sessionMessages: [],
+            conversationId: null, // Issued by the server; it keeps the history, so only new messages are sent
+            sendHistory: false, // Set once the server has lost the conversation: the history goes with each message instead
             inactivityTimer: null,
             agents: [],
             departments: []
@@ -327,6 +329,8 @@
                     user_id: config.userId,
                     agent_id: selectedAgent.id,
                     message: state.sessionMessages[0].text,
+                    // The server prefers the stored conversation, and falls back to this transcript if it's gone
+                    conversation_id: state.conversationId,
                     response: conversation,
                     platform: selectedAgent.helpdesk_platform || "zoho desk",
                     department_id: selectedAgent.helpdesk_department_id || null,
@@ -343,8 +347,8 @@
                     });
                     if (response.ok) {
                         const data = await response.json();
-                        addMessage(`Session ended. Ticket created: ${data.ticket_id}`, "system");
-                        console.log(`[${instanceId}] Ticket created: ${data.ticket_id}`);
+                        addMessage(`Session ended. Ticket submitted (reference ${data.job_id}).`, "system");
+                        console.log(`[${instanceId}] Ticket job queued: ${data.job_id}`);
                     } else {
                         const errorText = await response.text();
                         addMessage(`Failed to create ticket: ${errorText}`, "system");
@@ -356,6 +360,8 @@
                 }
             }
             state.sessionMessages = [];
+            state.conversationId = null;
+            state.sendHistory = false;
             persistedMessages.push(...state.sessionMessages);
             localStorage.setItem(chatHistoryKey, JSON.stringify(persistedMessages));
             resetInactivityTimer();
@@ -674,10 +680,10 @@
             try {
                 typingElement = showTypingAnimation();
                 const apiUrl = "http://localhost:8000/chat_widget";
-                const history = state.sessionMessages.map(msg => ({
+                const history = state.sendHistory ? state.sessionMessages.map(msg => ({
                     role: msg.role === "agent" ? "assistant" : msg.role,
                     content: msg.text
-                })).slice(0, -1);
+                })).slice(0, -1) : [];
                 const response = await fetch(apiUrl, {
                     method: "POST",
                     headers: { "Content-Type": "application/json" },
@@ -686,21 +692,35 @@
                         message: messageText,
                         department: state.customerInfo.department,
                         api_key: config.apiKey,
+                        conversation_id: state.conversationId,
                         history: history,
                         customer_email: state.customerInfo.email,
                         customer_name: state.customerInfo.name,
-                        language: state.customerInfo.language
+                        language: state.customerInfo.language,
+                        stream: true
                     })
                 });
-                removeTypingAnimation(typingElement);
                 if (!response.ok) {
+                    removeTypingAnimation(typingElement);
                     const errorText = await response.text();
                     let errorDetail = errorText;
                     try { errorDetail = JSON.parse(errorText).detail || errorText; } catch(e) {}
                     throw new Error(`Server error ${response.status}: ${errorDetail}`);
                 }
-                const data = await response.json();
+                let data;
+                if ((response.headers.get("Content-Type") || "").includes("text/event-stream")) {
+                    data = await readAgentStream(response, typingElement);
+                } else {
+                    removeTypingAnimation(typingElement);
+                    data = await response.json();
+                }
                 if (!data.response) throw new Error("Received empty response.");
+                if (data.conversation_id) state.conversationId = data.conversation_id;
+                if (data.conversation_reset) {
+                    // The server no longer has this conversation; keep it going from our own transcript
+                    state.conversationId = null;
+                    state.sendHistory = true;
+                }
                 if (data.agent && data.agent !== state.agentInfo.name) {
                     state.agentInfo.name = data.agent;
                     state.agentInfo.avatar = data.avatar_url || state.agentInfo.avatar;
@@ -710,7 +730,12 @@
                     updateAgentInfo();
                 }
                 const processedAgentText = processMessageText(data.response);
-                addMessage(processedAgentText, "agent", state.agentInfo.avatar, state.agentInfo.name);
+                if (data.contentElement) {
+                    // Streamed bubble is already on screen; settle it on the final sanitized text
+                    data.contentElement.innerHTML = processedAgentText;
+                } else {
+                    addMessage(processedAgentText, "agent", state.agentInfo.avatar, state.agentInfo.name);
+                }
                 state.sessionMessages.push({ 
                     text: data.response,
                     role: "agent", 
@@ -740,6 +765,49 @@
             }
         }
 
+        // Reads the Server-Sent Events stream from /chat_widget, rendering tokens into a live
+        // message bubble. Resolves with the "done" payload (same shape as the JSON response).
+        async function readAgentStream(response, typingElement) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+            let streamedText = "";
+            let contentElement = null;
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                let boundary;
+                while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                    const frame = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    let eventName = "message";
+                    let payload = "";
+                    frame.split("\n").forEach(line => {
+                        if (line.startsWith("event:")) eventName = line.slice(6).trim();
+                        else if (line.startsWith("data:")) payload += line.slice(5).trim();
+                    });
+                    if (!payload) continue;
+                    const data = JSON.parse(payload);
+                    if (eventName === "token") {
+                        if (!contentElement) {
+                            removeTypingAnimation(typingElement);
+                            contentElement = addMessage("", "agent", state.agentInfo.avatar, state.agentInfo.name);
+                        }
+                        streamedText += data.token;
+                        contentElement.innerHTML = processMessageText(`${state.agentInfo.name}: ${streamedText}`);
+                        elements.messages.scrollTop = elements.messages.scrollHeight;
+                    } else if (eventName === "done") {
+                        if (!contentElement) removeTypingAnimation(typingElement);
+                        return { ...data, contentElement };
+                    } else if (eventName === "error") {
+                        throw new Error(data.detail || "Streaming failed.");
+                    }
+                }
+            }
+            throw new Error("Stream ended before the response was complete.");
+        }
+
         function setupEventListeners() {
             if (elements.sendButton) {
                 elements.sendButton.onclick = sendMessage;
@@ -882,6 +950,7 @@
             setTimeout(() => {
                 elements.messages.scrollTop = elements.messages.scrollHeight;
             }, 0);
+            return contentDiv;
         }
 
         // --- Initialization ---